@@ -25,14 +25,17 @@ __docformat__ = 'restructuredtext'
 
 import sys
 import os
-import argparse
-import re
-from pathlib import Path
-import json
-from pygments import highlight as hilight
-from pygments.formatters.latex import LatexEmbeddedLexer, LatexFormatter
-from pygments.lexers import get_lexer_by_name
-from pygments.util import ClassNotFound
+import time
+from importlib import import_module
+_startup_time = time.perf_counter()
+_import_times = {}
+def lazy_import(name):
+  module = sys.modules.get(name)
+  if module is None:
+    start = time.perf_counter()
+    module = import_module(name)
+    _import_times[name] = time.perf_counter() - start
+  return module
 class BaseOpts(object):
   def __init__(self, d={}):
     for k, v in d.items():
@@ -50,7 +53,7 @@ class TeXOpts(BaseOpts):
 \makeatother'''
   def __init__(self, *args, **kvargs):
     super().__init__(*args, **kvargs)
-    self.pyg_sty_p = Path(self.pyg_sty_p or '')
+    self.pyg_sty_p = lazy_import('pathlib').Path(self.pyg_sty_p or '')
 class PygOpts(BaseOpts):
   style = 'default'
   nobackground = False
@@ -61,6 +64,7 @@ class PygOpts(BaseOpts):
   texcomments = False
   mathescape =  False
   escapeinside = ""
+  wrap = ""
   envname = 'Verbatim'
   lang = 'tex'
   def __init__(self, *args, **kvargs):
@@ -110,6 +114,123 @@ class Arguments(BaseOpts):
   texopts = TeXOpts()
   pygopts = PygOpts()
   fv_opts = FVOpts()
+class CDRWriter:
+  def __init__(self, outfile, is_inline, line=1, first=1, last=None):
+    self.outfile = outfile
+    self.is_inline = is_inline
+    self.line = line
+    self.first = first
+    self.last = last
+    self.eol = False
+    self.started = False
+    if not is_inline:
+      if max(line, first) > 1:
+        outfile.write(r'\CDR@Line{1}{}')
+        self.started = True
+      self.open()
+  def visible(self):
+    return self.first <= self.line and (
+      self.last is None or self.line <= self.last
+    )
+  def open(self):
+    if self.visible():
+      if self.started:
+        self.outfile.write('\n')
+      self.outfile.write(f'\\CDR@Line{{{self.line}}}{{')
+      self.started = True
+  def flush(self):
+    if self.eol:
+      self.eol = False
+      if self.is_inline:
+        self.outfile.write('\n')
+      else:
+        if self.visible():
+          self.outfile.write('}')
+        self.line += 1
+        self.open()
+  def write(self, text):
+    outfile = self.outfile
+    for i, part in enumerate(text.split('\n')):
+      if i:
+        self.flush()
+        self.eol = True
+      if part:
+        self.flush()
+        if self.is_inline:
+          outfile.write(part.replace(' ', r'\CDR@Sp '))
+        elif self.visible():
+          outfile.write(part)
+  def close(self):
+    if not self.is_inline and self.visible():
+      self.outfile.write('}')
+class PostWriter:
+  def __init__(self, outfile, post):
+    self.outfile = outfile
+    self.post = post
+  def write(self, text):
+    self.outfile.write(self.post(text))
+class AtomicFile:
+  def __init__(self, path, mode='w'):
+    self.path = os.fspath(path)
+    self.mode = mode
+  def __enter__(self):
+    self.tmp_p = f'{self.path}.{os.urandom(6).hex()}.tmp'
+    mode = self.mode.replace('w', 'x')
+    if 'b' in mode:
+      self.file = open(self.tmp_p, mode)
+    else:
+      self.file = open(self.tmp_p, mode, encoding='utf-8')
+    return self.file
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.file.close()
+    if exc_type is None:
+      os.replace(self.tmp_p, self.path)
+    else:
+      try:
+        os.remove(self.tmp_p)
+      except OSError:
+        pass
+    return False
+class FileLock:
+  STALE = 60
+  def __init__(self, path, timeout=STALE + 5):
+    self.path = f'{os.fspath(path)}.lock'
+    self.timeout = timeout
+    self.locked = False
+  def __enter__(self):
+    start = time.time()
+    while True:
+      try:
+        os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        self.locked = True
+        return self
+      except FileExistsError:
+        pass
+      except OSError:
+        if self.timeout:
+          raise
+        return self
+      try:
+        if time.time() - os.path.getmtime(self.path) > self.STALE:
+          os.remove(self.path)
+          continue
+      except FileNotFoundError:
+        continue
+      except OSError:
+        pass
+      if time.time() - start >= self.timeout:
+        if self.timeout:
+          raise TimeoutError(f'{self.path}: locked by another process')
+        return self
+      time.sleep(0.05)
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self.locked:
+      self.locked = False
+      try:
+        os.remove(self.path)
+      except OSError:
+        pass
+    return False
 class Controller:
   @staticmethod
   def object_hook(d):
@@ -127,21 +248,103 @@ class Controller:
     else:
       return Arguments(d)
   @staticmethod
+  def lua_frame(tag, payload):
+    n = len(payload.encode('utf-8'))
+    sys.stdout.write(f'\x01{tag}{n}\n{payload}\n')
+  @staticmethod
   def lua_command(cmd):
-    print(f'<<<<<*LUA:{cmd}>>>>>')
+    Controller.lua_frame('*', cmd)
   @staticmethod
   def lua_command_now(cmd):
-    print(f'<<<<<!LUA:{cmd}>>>>>')
+    Controller.lua_frame('!', cmd)
   @staticmethod
   def lua_debug(msg):
-    print(f'<<<<<?LUA:{msg}>>>>>')
+    Controller.lua_frame('?', msg)
+  @staticmethod
+  def lua_tex(text):
+    Controller.lua_frame('T', text)
+  @staticmethod
+  def lua_stats(stats):
+    Controller.lua_frame('S', ''.join(
+      f'{phase} {t:.6f}\n' for phase, t in stats.items()
+    ))
+  @staticmethod
+  def lua_pack(fp, offset, length):
+    Controller.lua_frame('P', f'{fp}\t{offset}\t{length}')
+  @staticmethod
+  def lua_lang(fp, lang):
+    Controller.lua_frame('L', f'{fp}\t{lang}')
+  @staticmethod
+  def lua_types(fp, styles):
+    types = {t for style in styles for t in style.split('+') if t}
+    Controller.lua_frame('Y', f'{fp}\t{",".join(sorted(types))}')
   @staticmethod
   def lua_text_escape(s):
     k = 0
-    for m in re.findall('=+', s):
+    for m in lazy_import('re').findall('=+', s):
       if len(m) > k: k = len(m)
     k = (k + 1) * "="
     return f'[{k}[{s}]{k}]'
+  @staticmethod
+  def salt():
+    from pygments import __version__ as pygments_version
+    return f'coder-tool {__version__} pygments {pygments_version}'
+  @staticmethod
+  def user_cache_dir():
+    Path = lazy_import('pathlib').Path
+    p = os.environ.get('CODER_CACHE_DIR')
+    if p:
+      return Path(p)
+    if sys.platform == 'win32':
+      p = os.environ.get('LOCALAPPDATA') or Path.home() / 'AppData' / 'Local'
+    elif sys.platform == 'darwin':
+      p = Path.home() / 'Library' / 'Caches'
+    else:
+      p = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(p) / 'coder'
+  _lexer_index = None
+  @staticmethod
+  def lexer_index():
+    index = Controller._lexer_index
+    if index is not None:
+      return index
+    json = lazy_import('json')
+    version = lazy_import('pygments').__version__
+    index_p = Controller.user_cache_dir() / 'lexers.json'
+    try:
+      with open(index_p, 'r', encoding='utf-8') as f:
+        d = json.load(f)
+      if d.get('pygments') == version:
+        index = Controller._lexer_index = d['aliases']
+        return index
+    except (OSError, ValueError, KeyError):
+      pass
+    index = {}
+    mapping = lazy_import('pygments.lexers._mapping')
+    for module_name, name, aliases, _, _ in mapping.LEXERS.values():
+      for alias in aliases:
+        index.setdefault(alias.lower(), [module_name, name])
+    plugin = lazy_import('pygments.plugin')
+    for cls in plugin.find_plugin_lexers():
+      for alias in cls.aliases:
+        index.setdefault(alias.lower(), [cls.__module__, cls.__name__])
+    Controller._lexer_index = index
+    try:
+      index_p.parent.mkdir(parents = True, exist_ok = True)
+      with AtomicFile(index_p) as f:
+        json.dump({ 'pygments': version, 'aliases': index }, f)
+    except OSError:
+      pass
+    return index
+  @staticmethod
+  def lexer_by_name(name):
+    entry = Controller.lexer_index().get(name.lower())
+    if entry:
+      try:
+        return getattr(lazy_import(entry[0]), entry[1])()
+      except (ImportError, AttributeError):
+        pass
+    return lazy_import('pygments.lexers').get_lexer_by_name(name)
   _json_p = None
   @property
   def json_p(self):
@@ -151,11 +354,12 @@ class Controller:
     else:
       p = self.arguments.json
       if p:
-        p = Path(p).resolve()
+        p = lazy_import('pathlib').Path(p).resolve()
     self._json_p = p
     return p
   @property
   def parser(self):
+    argparse = lazy_import('argparse')
     parser = argparse.ArgumentParser(
       prog=sys.argv[0],
       description='''
@@ -170,110 +374,527 @@ the syntax hilighting of the input file as given by pygments.
       version=f'coder-tool version {__version__},'
       ' (c) {__YEAR__} by Jérôme LAURENS.'
     )
+    parser.add_argument(
+      "--salt",
+      action='version',
+      version=Controller.salt(),
+      help="Print the versions of coder-tool and pygments and exit,"
+      " used in the cache fingerprints"
+    )
     parser.add_argument(
       "--debug",
       action='store_true',
       default=None,
       help="display informations useful for debugging"
     )
+    parser.add_argument(
+      "--startup-report",
+      action='store_true',
+      default=None,
+      help="print to the standard error the time spent importing modules"
+    )
     parser.add_argument(
       "--create_style",
       action='store_true',
       default=None,
       help="create the style definitions"
     )
+    parser.add_argument(
+      "--types",
+      action='store',
+      default=None,
+      metavar="<types>",
+      help="with --create_style, only define the given comma separated"
+      " token types"
+    )
     parser.add_argument(
       "--base",
       action='store',
       default=None,
       help="the path of the file to be colored, with no extension"
     )
+    parser.add_argument(
+      "--print-tex",
+      action='store_true',
+      default=None,
+      help="also print the colored text in a frame, see lua_frame"
+    )
+    parser.add_argument(
+      "--report-types",
+      action='store_true',
+      default=None,
+      help="send the token types of the colored text back in a frame"
+    )
+    parser.add_argument(
+      "--stats",
+      action='store_true',
+      default=None,
+      help="time each processing phase and send the timings in a frame"
+    )
+    parser.add_argument(
+      "--block",
+      action='store',
+      default=None,
+      metavar="<checkpoint>",
+      help="the checkpoint file used to hilight a block incrementally"
+    )
+    parser.add_argument(
+      "--stream",
+      action='store',
+      default=None,
+      metavar="<source>",
+      help="hilight the block read from the given file, in bounded memory"
+        " for a line bounded lexer like tex or diff and for plain text,"
+        " see lexer_bounds"
+    )
+    parser.add_argument(
+      "--guess",
+      action='store',
+      default=None,
+      metavar="<fingerprint>",
+      help="with lang=auto, send the guessed language back"
+      " in a frame with the given fingerprint"
+    )
+    parser.add_argument(
+      "--pack",
+      action='store',
+      default=None,
+      metavar="<pack>",
+      help="append the hilighted code to the given pack file"
+      " instead of writing a file"
+    )
+    parser.add_argument(
+      "--serve",
+      action='store',
+      default=None,
+      metavar="<fifo>",
+      help="""
+serve the requests read from the standard input,
+one command line per request, until end of file.
+Responses are written to the given named pipe.
+"""
+    )
+    parser.add_argument(
+      "--preload",
+      action='store',
+      default=None,
+      metavar="<languages>",
+      help="""
+with --serve, the comma separated languages whose lexers are loaded
+while the server waits for requests, one language at a time.
+A request is never delayed by the preloading of another language.
+"""
+    )
+    parser.add_argument(
+      "--store",
+      action='store',
+      default=None,
+      metavar="<directory>",
+      help="the shared store where hilighted snippets are also saved"
+    )
+    parser.add_argument(
+      "--store-size",
+      action='store',
+      type=int,
+      default=256,
+      metavar="<megabytes>",
+      help="the size budget of the shared store, defaults to 256"
+    )
     parser.add_argument(
       "json",
       metavar="<json data file>",
+      nargs='?',
       help="""
 file name with extension, contains processing information.
 """
     )
     return parser
 
-  def __init__(self, argv = sys.argv):
-    argv = argv[1:] if re.match(".*coder\-tool\.py$", argv[0]) else argv
-    ns = self.parser.parse_args(
+  def __init__(self, argv = sys.argv, arguments = None):
+    self._tick = time.perf_counter()
+    argv = argv[1:] if argv[0].endswith('coder-tool.py') else argv
+    ns = self.ns = self.parser.parse_args(
       argv if len(argv) else ['-h']
     )
-    with open(ns.json, 'r') as f:
-      self.arguments = json.load(
-        f,
-        object_hook = Controller.object_hook
-      )
+    self.stats = {} if ns.stats else None
+    if ns.serve:
+      return
+    if arguments is None:
+      if not ns.json:
+        self.parser.error('missing <json data file>')
+      with open(ns.json, 'r') as f:
+        arguments = lazy_import('json').load(
+          f,
+          object_hook = Controller.object_hook
+        )
+      arguments.json = ns.json
+    self.arguments = arguments
     args = self.arguments
-    args.json = ns.json
     self.texopts = args.texopts
-    pygopts = self.pygopts = args.pygopts
-    fv_opts = self.fv_opts = args.fv_opts
-    self.formatter = LatexFormatter(
-      style = pygopts.style,
-      nobackground = pygopts.nobackground,
-      commandprefix = pygopts.commandprefix,
-      texcomments  = pygopts.texcomments,
-      mathescape   = pygopts.mathescape,
-      escapeinside = pygopts.escapeinside,
-      envname = 'CDR@Pyg@Verbatim',
-    )
+    self.pygopts = args.pygopts
+    self.fv_opts = args.fv_opts
+    args.base = ns.base
+    args.create_style = ns.create_style
+    if ns.debug:
+      args.debug = True
+    self.tick('load')
+    # IN PROGRESS: support for extra keywords
+    # EXTRA_KEYWORDS = set(('foo', 'bar', 'foobar', 'barfoo', 'spam', 'eggs'))
+    # def over(self, text):
+    #   for index, token, value in lexer.__class__.get_tokens_unprocessed(self, text):
+    #     if token is Name and value in EXTRA_KEYWORDS:
+    #       yield index, Keyword.Pseudo, value
+    #   else:
+    #       yield index, token, value
+    # lexer.get_tokens_unprocessed = over.__get__(lexer)
 
+  def tick(self, phase):
+    stats = self.stats
+    if stats is None:
+      return
+    t = time.perf_counter()
+    stats[phase] = stats.get(phase, 0) + t - self._tick
+    self._tick = t
+  def stats_flush(self):
+    stats = self.stats
+    if stats:
+      Controller.lua_stats(stats)
+      stats.clear()
+  LRU_SIZE = 32
+  _lru_caches = {}
+  @staticmethod
+  def lru_cached(factory, *key):
+    cache = Controller._lru_caches.get(factory)
+    if cache is None:
+      cache = Controller._lru_caches[factory] = lazy_import(
+        'functools'
+      ).lru_cache(maxsize = Controller.LRU_SIZE)(getattr(Controller, factory))
+    return cache(*key)
+  @staticmethod
+  def make_formatter(
+    style, commandprefix, texcomments, mathescape, escapeinside, nobackground,
+    wrap = '',
+  ):
+    latex = lazy_import('pygments.formatters.latex')
+    formatter = latex.LatexFormatter(
+      style = style,
+      nobackground = nobackground,
+      commandprefix = commandprefix,
+      texcomments  = texcomments,
+      mathescape   = mathescape,
+      escapeinside = escapeinside,
+      nowrap = True,
+    )
+    post = Controller.lru_cached('make_post', commandprefix, wrap)
+    if post:
+      formatter.format = lazy_import('functools').partial(
+        Controller.post_format, formatter, post
+      )
+    return formatter
+  @staticmethod
+  def post_format(formatter, post, tokens, outfile):
+    return type(formatter).format(formatter, tokens, PostWriter(outfile, post))
+  @staticmethod
+  def make_post(commandprefix, wrap):
+    table = Controller.wrap_table(wrap)
+    if not table:
+      return None
+    re = lazy_import('re')
+    bs = f'\\{commandprefix}Zbs{{}}'
+    escaped = re.escape(bs)
+    cmds = '|'.join(
+      re.escape(cmd) for cmd in sorted(table, key=len, reverse=True)
+    )
+    wrappers = '|'.join(re.escape(w) for w in sorted(set(table.values())))
+    pattern = re.compile(
+      rf'\{{(?:\\(?:{wrappers})\{{{escaped}(?:{cmds})\}}\}}'
+      rf'|{escaped}({cmds})\}})'
+    )
+    def replace(m):
+      cmd = m.group(1)
+      if cmd is None:
+        return m.group(0)
+      return f'{{\\{table[cmd]}{{{bs}{cmd}}}}}'
+    def post(text):
+      return pattern.sub(replace, text) if bs in text else text
+    return post
+  @staticmethod
+  def wrap_table(wrap):
+    table = {}
+    for item in wrap.split(';'):
+      wrapper, _, cmds = item.partition(':')
+      wrapper = wrapper.strip().lstrip('\\')
+      for cmd in cmds.split(','):
+        cmd = cmd.strip().lstrip('\\')
+        if wrapper and cmd:
+          table[cmd] = wrapper
+    return table
+  @staticmethod
+  def make_lexer(lang, escapeinside, gobble, tabsize):
     try:
-      lexer = self.lexer = get_lexer_by_name(pygopts.lang)
-    except ClassNotFound as err:
+      lexer = Controller.lexer_by_name(lang)
+    except lazy_import('pygments.util').ClassNotFound as err:
       sys.stderr.write('Error: ')
       sys.stderr.write(str(err))
+      raise
 
-    escapeinside = pygopts.escapeinside
     # When using the LaTeX formatter and the option `escapeinside` is
     # specified, we need a special lexer which collects escaped text
     # before running the chosen language lexer.
     if len(escapeinside) == 2:
       left  = escapeinside[0]
       right = escapeinside[1]
-      lexer = self.lexer = LatexEmbeddedLexer(left, right, lexer)
+      latex = lazy_import('pygments.formatters.latex')
+      lexer = latex.LatexEmbeddedLexer(left, right, lexer)
+      lexer.get_tokens_unprocessed = lazy_import('functools').partial(
+        Controller.escape_tokens, lexer
+      )
 
-    gobble = fv_opts.gobble
     if gobble:
       lexer.add_filter('gobble', n=gobble)
-    tabsize = fv_opts.tabsize
     if tabsize:
       lexer.tabsize = tabsize
     lexer.encoding = ''
-    args.base = ns.base
-    args.create_style = ns.create_style
-    if ns.debug:
-      args.debug = True
-    # IN PROGRESS: support for extra keywords
-    # EXTRA_KEYWORDS = set(('foo', 'bar', 'foobar', 'barfoo', 'spam', 'eggs'))
-    # def over(self, text):
-    #   for index, token, value in lexer.__class__.get_tokens_unprocessed(self, text):
-    #     if token is Name and value in EXTRA_KEYWORDS:
-    #       yield index, Keyword.Pseudo, value
-    #   else:
-    #       yield index, token, value
-    # lexer.get_tokens_unprocessed = over.__get__(lexer)
-
+    return lexer
+  _formatter = None
+  @property
+  def formatter(self):
+    formatter = self._formatter
+    if formatter is None:
+      pygopts = self.pygopts
+      formatter = self._formatter = Controller.lru_cached(
+        'make_formatter',
+        pygopts.style,
+        pygopts.commandprefix,
+        pygopts.texcomments,
+        pygopts.mathescape,
+        pygopts.escapeinside,
+        pygopts.nobackground,
+        pygopts.wrap,
+      )
+    return formatter
+  _lexer = None
+  @property
+  def lexer(self):
+    lexer = self._lexer
+    if lexer is None:
+      pygopts = self.pygopts
+      fv_opts = self.fv_opts
+      lexer = self._lexer = Controller.lru_cached(
+        'make_lexer',
+        pygopts.lang,
+        pygopts.escapeinside,
+        fv_opts.gobble,
+        fv_opts.tabsize,
+      )
+    return lexer
+  GUESS_SIZE = 4096
+  SHEBANG = r'#!\s*(?:\S*/env\s+(?:-\S+\s+)*)?(?:\S*/)?([A-Za-z][\w+#.-]*)'
+  MODELINE = (
+    r'-\*-\s*([\w+#-]+)\s*-\*-'
+    r'|-\*-.*?\bmode:\s*([\w+#-]+)'
+    r'|\b(?:vi|vim|ex):.*?\b(?:ft|filetype|syntax)=([\w+#-]+)'
+  )
+  @staticmethod
+  def guess_lang(text):
+    re = lazy_import('re')
+    index = Controller.lexer_index()
+    lines = text.lstrip().split('\n', 2)
+    candidates = []
+    m = re.match(Controller.SHEBANG, lines[0])
+    if m:
+      name = m.group(1).lower()
+      candidates += [name, name.rstrip('0123456789.')]
+    for line in lines[:2] + [text.rstrip().rsplit('\n', 1)[-1]]:
+      for m in re.finditer(Controller.MODELINE, line):
+        candidates.append((m.group(1) or m.group(2) or m.group(3)).lower())
+    for name in candidates:
+      if name in index:
+        return name
+    try:
+      lexer = lazy_import('pygments.lexers').guess_lexer(
+        text[:Controller.GUESS_SIZE]
+      )
+    except lazy_import('pygments.util').ClassNotFound:
+      return 'text'
+    return lexer.aliases[0] if lexer.aliases else 'text'
+  def guess(self, text):
+    pygopts = self.pygopts
+    if pygopts.lang != 'auto':
+      return
+    lang = pygopts.lang = Controller.lru_cached('guess_lang', text)
+    if self.ns.guess:
+      Controller.lua_lang(self.ns.guess, lang)
+    self.tick('guess')
+  @staticmethod
+  def escape_tokens(lexer, text):
+    pyg_lexer = lazy_import('pygments.lexer')
+    lang = lexer.lang
+    regex = type(lang).get_tokens_unprocessed \
+      is pyg_lexer.RegexLexer.get_tokens_unprocessed
+    tokens = []
+    states = {}
+    if regex:
+      for pos, ttype, value in Controller.regex_tokens(
+        lang, text, 0, ('root',)
+      ):
+        if ttype is not None:
+          tokens.append((pos, ttype, value))
+        else:
+          states.setdefault(pos, (value, len(tokens)))
+    else:
+      tokens = list(lang.get_tokens_unprocessed(text))
+    kept, insertions = Controller.escape_parts(lexer, tokens)
+    if not insertions:
+      yield from tokens
+      return
+    buffered = ''.join(v for _, v in kept)
+    if regex:
+      tokens = Controller.escape_splice(lang, text, buffered, tokens, states, kept)
+    else:
+      tokens = lang.get_tokens_unprocessed(buffered)
+    yield from pyg_lexer.do_insertions(insertions, tokens)
+  @staticmethod
+  def escape_parts(lexer, tokens):
+    token = lazy_import('pygments.token')
+    left, right = lexer.left, lexer.right
+    verbatim = {}
+    kept = []
+    insertions = []
+    insertion_buf = []
+    size = 0
+    def keep(i, v):
+      nonlocal insertion_buf, size
+      if insertion_buf:
+        insertions.append((size, insertion_buf))
+        insertion_buf = []
+      kept.append((i, v))
+      size += len(v)
+    def scan(i, run):
+      if left not in run:
+        keep(i, run)
+        return
+      while run:
+        a, sep1, run = run.partition(left)
+        if a:
+          keep(i, a)
+          i += len(a)
+        if sep1:
+          b, sep2, run = run.partition(right)
+          if sep2:
+            insertion_buf.append((i + len(sep1), token.Escape, b))
+            i += len(sep1) + len(b) + len(sep2)
+          else:
+            insertion_buf.append((i, token.Error, sep1))
+            i += len(sep1)
+            run = b
+    run = []
+    start = 0
+    for i, t, v in tokens:
+      is_verbatim = verbatim.get(t)
+      if is_verbatim is None:
+        is_verbatim = verbatim[t] = t in token.Comment or t in token.String
+      if is_verbatim:
+        if run:
+          scan(start, ''.join(run))
+          run = []
+        keep(i, v)
+      else:
+        if not run:
+          start = i
+        run.append(v)
+    if run:
+      scan(start, ''.join(run))
+    if insertion_buf:
+      insertions.append((size, insertion_buf))
+    return kept, insertions
+  @staticmethod
+  def escape_splice(lexer, text, buffered, tokens, states, kept):
+    bisect = lazy_import('bisect')
+    line_bounded, lookbehind, _ = Controller.lexer_bounds(lexer)
+    changes = []
+    o = b = 0
+    for i, v in kept:
+      if i > o:
+        changes.append((b, i - o, o))
+      o = i + len(v)
+      b += len(v)
+    if o < len(text):
+      changes.append((b, len(text) - o, o))
+    starts = sorted(states)
+    shift = 0
+    k = 0
+    o = 0
+    while k < len(changes):
+      resume = o
+      if line_bounded:
+        at = text.rfind('\n', 0, changes[k][2]) + 1
+        if at:
+          at = text.rfind('\n', 0, at - 1) + 1
+        resume = max(o, starts[bisect.bisect_right(starts, at) - 1])
+      for pos, ttype, value in tokens[states[o][1]:states[resume][1]]:
+        yield pos - shift, ttype, value
+      unchanged = None
+      last = None
+      for pos, ttype, value in Controller.regex_tokens(
+        lexer, buffered, resume - shift, states[resume][0]
+      ):
+        if ttype is not None:
+          yield pos, ttype, value
+          continue
+        if pos == last or pos and buffered[pos - 1] != '\n':
+          continue
+        last = pos
+        while k < len(changes) and changes[k][0] < pos:
+          shift += changes[k][1]
+          unchanged = buffered.find('\n', changes[k][0]) + 1 or len(buffered)
+          k += 1
+        if unchanged is not None and pos - unchanged > lookbehind:
+          state = states.get(pos + shift)
+          if state and state[0] == value:
+            o = pos + shift
+            break
+      else:
+        return
+    for pos, ttype, value in tokens[states[o][1]:]:
+      yield pos - shift, ttype, value
   def create_style(self):
     args = self.arguments
     if not args.create_style:
       return
     texopts = args.texopts
     pyg_sty_p = texopts.pyg_sty_p
-    if args.cache and pyg_sty_p.exists():
-      return
-    texopts = self.texopts
-    style = self.pygopts.style
-    formatter = self.formatter
+    pygopts = self.pygopts
+    sty = Controller.style_defs(
+      pygopts.style,
+      pygopts.commandprefix,
+      pygopts.nobackground,
+    )
+    if self.ns.types is not None:
+      sty = Controller.trim_style(sty, pygopts.commandprefix, self.ns.types)
+    self.tick('style')
+    with AtomicFile(pyg_sty_p) as f:
+      f.write(sty)
+    self.tick('write')
+    if args.debug:
+      print('STYLE', os.path.relpath(pyg_sty_p))
+    self.stats_flush()
+  @staticmethod
+  def style_store_dir():
+    version = lazy_import('pygments').__version__
+    return Controller.user_cache_dir() / 'styles' \
+      / f'{__version__}-pygments-{version}'
+  @staticmethod
+  def render_style(style, commandprefix, nobackground):
+    formatter = Controller.lru_cached(
+      'make_formatter',
+      style, commandprefix, False, False, '', nobackground,
+    )
     style_defs = formatter.get_style_defs() \
       .replace(r'\makeatletter', '') \
       .replace(r'\makeatother', '') \
       .replace('\n', '%\n')
-    sty = self.texopts.sty_template.replace(
+    return TeXOpts.sty_template.replace(
       '<placeholder:style_name>',
       style,
     ).replace(
@@ -289,50 +910,597 @@ file name with extension, contains processing information.
       '{]}%',
       '{%[\n]}%'
     )
-    with pyg_sty_p.open(mode='w',encoding='utf-8') as f:
-      f.write(sty)
-    if args.debug:
-      print('STYLE', os.path.relpath(pyg_sty_p))
-  def pygmentize(self, source):
-    source = hilight(source, self.lexer, self.formatter)
-    m = re.match(
-      r'\\begin{CDR@Pyg@Verbatim}.*?\n(.*?)\n\\end{CDR@Pyg@Verbatim}\s*\Z',
-      source,
-      flags=re.S
-    )
-    assert(m)
-    hilighted = m.group(1)
+  @staticmethod
+  def style_defs(style, commandprefix, nobackground):
+    name = f'{style}-{commandprefix}'
+    if nobackground:
+      name += '-nobg'
+    store_p = Controller.style_store_dir() / f'{name}.pyg.sty'
+    try:
+      with store_p.open(mode='r',encoding='utf-8') as f:
+        return f.read()
+    except OSError:
+      pass
+    try:
+      store_p.parent.mkdir(parents=True, exist_ok=True)
+    except OSError:
+      pass
+    try:
+      with FileLock(store_p):
+        try:
+          with store_p.open(mode='r',encoding='utf-8') as f:
+            return f.read()
+        except OSError:
+          pass
+        sty = Controller.render_style(style, commandprefix, nobackground)
+        try:
+          with AtomicFile(store_p) as f:
+            f.write(sty)
+        except OSError:
+          pass
+    except OSError:
+      sty = Controller.render_style(style, commandprefix, nobackground)
+    return sty
+  @staticmethod
+  def trim_style(sty, commandprefix, types):
+    keep = set(types.split(','))
+    prefix = f'\\@namedef{{{commandprefix}@tok@'
+    return ''.join(
+      line for line in sty.splitlines(True)
+      if not line.startswith(prefix)
+      or line[len(prefix):].partition('}')[0] in keep
+    )
+  @staticmethod
+  def types_pattern(commandprefix):
+    re = lazy_import('re')
+    return re.compile(rf'\\{re.escape(commandprefix)}\{{([^{{}}]*)\}}\{{')
+  @staticmethod
+  def styles(argv):
+    parser = lazy_import('argparse').ArgumentParser(
+      prog=f'{sys.argv[0]} styles',
+      description='''
+Render the style definitions in the user level style store,
+for all the installed pygments styles or only the given ones.
+'''
+    )
+    parser.add_argument(
+      "--commandprefix",
+      action='store',
+      default=PygOpts.commandprefix,
+      help=f"the command prefix, defaults to {PygOpts.commandprefix}"
+    )
+    parser.add_argument(
+      "--nobackground",
+      action='store_true',
+      default=None,
+      help="render the styles without background"
+    )
+    parser.add_argument(
+      "style",
+      metavar="<style>",
+      nargs='*',
+      help="the style names, defaults to all the installed styles"
+    )
+    ns = parser.parse_args(argv)
+    styles = ns.style or sorted(
+      lazy_import('pygments.styles').get_all_styles()
+    )
+    for style in styles:
+      Controller.style_defs(style, ns.commandprefix, bool(ns.nobackground))
+    print(f'{sys.argv[0]}: {len(styles)} styles in {Controller.style_store_dir()}')
+    return 0
+  def pygmentize(self, source, outfile=None):
+    if outfile is None:
+      io = lazy_import('io')
+      outfile = io.StringIO()
+      self.pygmentize(source, outfile)
+      return outfile.getvalue()
     texopts = self.texopts
+    lines = None
+    last = None
     if texopts.is_inline:
-      s = r'\CDR@Setup{'
-      if texopts.synctex_tag:
-        s += f'synctex_tag={texopts.synctex_tag},'
-      if texopts.synctex_line:
-        s += f'synctex_line={texopts.synctex_line},'
-      s+='}'
-      return s + hilighted.replace(' ', r'\CDR@Sp ')+r'\ignorespaces'
-    lines = hilighted.split('\n')
-    ans_code = []
-    last = 0
-    for line in lines:
-      last += 1
-      ans_code.append(rf'''\CDR@Line{{{last}}}{{{line}}}''')
-    if last:
-      s = r'\CDR@Setup{'
-      s += f'last={last},'
-      if texopts.synctex_tag:
-        s += f'synctex_tag={texopts.synctex_tag},'
-      if texopts.synctex_line:
-        s += f'synctex_line={texopts.synctex_line},'
-      s+='}'
-      ans_code.insert(0, s)
-    hilighted = '\n'.join(ans_code)
-    return hilighted
+      tokens = self.lexer.get_tokens(source)
+    else:
+      fv_opts = self.fv_opts
+      if fv_opts.firstline or fv_opts.lastline:
+        text = self.lexer._preprocess_lexer_input(source)
+        last = text.count('\n')
+        if self.line_range(last):
+          io = lazy_import('io')
+          self.pygmentize_lines(io.StringIO(text), last, outfile)
+          return
+      if self.ns.block:
+        lines = self.relex(source)
+      if lines is None:
+        tokens = list(self.lexer.get_tokens(source))
+        last = sum(value.count('\n') for _, value in tokens)
+      else:
+        last = len(lines)
+    outfile.write(self.setup(last))
+    if lines is not None:
+      outfile.write('\n'.join(
+        rf'\CDR@Line{{{i}}}{{{line}}}' for i, line in enumerate(lines, 1)
+      ))
+      return
+    writer = CDRWriter(outfile, texopts.is_inline)
+    self.formatter.format(tokens, writer)
+    writer.close()
+    if texopts.is_inline:
+      outfile.write(r'\ignorespaces')
+  def setup(self, last):
+    texopts = self.texopts
+    s = r'\CDR@Setup{'
+    if last is not None:
+      s += f'last={max(last, 1)},'
+    if texopts.synctex_tag:
+      s += f'synctex_tag={texopts.synctex_tag},'
+    if texopts.synctex_line:
+      s += f'synctex_line={texopts.synctex_line},'
+    s += '}'
+    if last is not None:
+      s += '\n'
+    return s
+  _lexer_bounds = {}
+  @staticmethod
+  def lexer_bounds(lexer):
+    bounds = Controller._lexer_bounds.get(type(lexer))
+    if bounds is not None:
+      return bounds
+    try:
+      sre = lazy_import('re._parser')
+    except ImportError:
+      sre = lazy_import('sre_parse')
+    re = lazy_import('re')
+    repeats = (
+      sre.MAX_REPEAT, sre.MIN_REPEAT, getattr(sre, 'POSSESSIVE_REPEAT', None)
+    )
+    singles = (sre.LITERAL, sre.NOT_LITERAL, sre.IN, sre.ANY)
+    newline_categories = (
+      sre.CATEGORY_SPACE, sre.CATEGORY_NOT_DIGIT, sre.CATEGORY_NOT_WORD,
+      sre.CATEGORY_LINEBREAK, sre.CATEGORY_UNI_SPACE,
+      sre.CATEGORY_UNI_NOT_DIGIT, sre.CATEGORY_UNI_NOT_WORD,
+      sre.CATEGORY_UNI_LINEBREAK,
+    )
+    lookbehind = 0
+    multiline = False
+    def in_newline(items):
+      negate = False
+      ans = False
+      for op, av in items:
+        if op is sre.NEGATE:
+          negate = True
+        elif op is sre.LITERAL:
+          ans = ans or av == 10
+        elif op is sre.RANGE:
+          ans = ans or av[0] <= 10 <= av[1]
+        elif op is sre.CATEGORY:
+          ans = ans or av in newline_categories
+        else:
+          ans = True
+      return ans != negate
+    def newline(items, dotall):
+      nonlocal lookbehind
+      for op, av in items:
+        if op is sre.LITERAL:
+          ans = av == 10
+        elif op is sre.NOT_LITERAL:
+          ans = av != 10
+        elif op is sre.ANY:
+          ans = dotall
+        elif op is sre.IN:
+          ans = in_newline(av)
+        elif op in repeats:
+          ans = newline(av[2], dotall)
+        elif op is sre.SUBPATTERN:
+          ans = newline(av[3], (dotall or av[1] & re.S) and not av[2] & re.S)
+        elif op is sre.BRANCH:
+          ans = any([newline(b, dotall) for b in av[1]])
+        elif op in (sre.ASSERT, sre.ASSERT_NOT):
+          if av[0] < 0:
+            lookbehind = max(lookbehind, av[1].getwidth()[1])
+          ans = newline(av[1], dotall)
+        elif op is getattr(sre, 'ATOMIC_GROUP', None):
+          ans = newline(av, dotall)
+        elif op is sre.AT:
+          ans = False
+        else:
+          ans = True
+        if ans:
+          return True
+      return False
+    def bounded(items, dotall):
+      nonlocal multiline
+      items = list(items)
+      if not items:
+        return True
+      if newline(items[:-1], dotall):
+        return False
+      op, av = items[-1]
+      if op is sre.SUBPATTERN:
+        return bounded(av[3], (dotall or av[1] & re.S) and not av[2] & re.S)
+      if op is sre.BRANCH:
+        return all([bounded(b, dotall) for b in av[1]])
+      if op in singles:
+        return True
+      if op in repeats and len(av[2]) == 1 and av[2][0][0] in singles:
+        multiline = multiline or newline(av[2], dotall)
+        return True
+      return not newline(items[-1:], dotall)
+    line_bounded = True
+    for rules in lexer._tokens.values():
+      for rexmatch, _, _ in rules:
+        pattern = rexmatch.__self__
+        items = sre.parse(pattern.pattern, pattern.flags)
+        if not bounded(items, pattern.flags & re.S):
+          line_bounded = False
+    stateless = line_bounded and not multiline and len(lexer._tokens) == 1
+    bounds = Controller._lexer_bounds[type(lexer)] = (
+      line_bounded, lookbehind, stateless
+    )
+    return bounds
+  @staticmethod
+  def regex_tokens(lexer, text, pos, stack):
+    token = lazy_import('pygments.token')
+    _TokenType = type(token.Token)
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    while 1:
+      if pos == 0 or text[pos - 1] == '\n':
+        yield pos, None, tuple(statestack)
+      for rexmatch, action, new_state in statetokens:
+        m = rexmatch(text, pos)
+        if m:
+          if action is not None:
+            if type(action) is _TokenType:
+              yield pos, action, m.group()
+            else:
+              yield from action(lexer, m)
+          pos = m.end()
+          if new_state is not None:
+            if isinstance(new_state, tuple):
+              for state in new_state:
+                if state == '#pop':
+                  if len(statestack) > 1:
+                    statestack.pop()
+                elif state == '#push':
+                  statestack.append(statestack[-1])
+                else:
+                  statestack.append(state)
+            elif isinstance(new_state, int):
+              if abs(new_state) >= len(statestack):
+                del statestack[1:]
+              else:
+                del statestack[new_state:]
+            elif new_state == '#push':
+              statestack.append(statestack[-1])
+            statetokens = tokendefs[statestack[-1]]
+          break
+      else:
+        try:
+          if text[pos] == '\n':
+            statestack = ['root']
+            statetokens = tokendefs['root']
+            yield pos, token.Whitespace, '\n'
+            pos += 1
+            continue
+          yield pos, token.Error, text[pos]
+          pos += 1
+        except IndexError:
+          break
+  def relex(self, source):
+    lexer = self.lexer
+    pyg_lexer = lazy_import('pygments.lexer')
+    if type(lexer).get_tokens_unprocessed \
+      is not pyg_lexer.RegexLexer.get_tokens_unprocessed \
+      or not lexer.ensurenl \
+      or any(type(f).__name__ != 'GobbleFilter' for f in lexer.filters):
+      return None
+    json = lazy_import('json')
+    hashlib = lazy_import('hashlib')
+    pygopts = self.pygopts
+    fv_opts = self.fv_opts
+    key = [
+      Controller.salt(),
+      pygopts.lang, pygopts.style, pygopts.commandprefix,
+      pygopts.texcomments, pygopts.mathescape, pygopts.wrap,
+      fv_opts.gobble, fv_opts.tabsize,
+    ]
+    text = lexer._preprocess_lexer_input(source)
+    starts = [0]
+    hashes = []
+    for line in text.split('\n')[:-1]:
+      starts.append(starts[-1] + len(line) + 1)
+      hashes.append(hashlib.md5(line.encode('utf-8')).hexdigest())
+    n_new = len(hashes)
+    old = None
+    ckpt_p = self.ns.block
+    try:
+      with open(ckpt_p, 'r', encoding='utf-8') as f:
+        old = json.load(f)
+      if old['key'] != key:
+        old = None
+    except (OSError, ValueError, KeyError):
+      old = None
+    if old is None:
+      old = { 'hashes': [], 'states': [], 'lines': [] }
+    old_hashes = old['hashes']
+    old_states = old['states']
+    n_old = len(old_hashes)
+    prefix = 0
+    while prefix < min(n_new, n_old) \
+      and hashes[prefix] == old_hashes[prefix]:
+      prefix += 1
+    suffix = 0
+    while suffix < min(n_new, n_old) - prefix \
+      and hashes[-1 - suffix] == old_hashes[-1 - suffix]:
+      suffix += 1
+    line_bounded, lookbehind, _ = Controller.lexer_bounds(lexer)
+    resume = 0
+    stack = ('root',)
+    if line_bounded and prefix > 1:
+      resume = prefix - 1
+      while resume > 0 and old_states[resume] is None:
+        resume -= 1
+      if resume:
+        stack = tuple(old_states[resume])
+    states = old_states[:resume] + [None] * (n_new - resume)
+    lines = old['lines'][:resume]
+    line_of = { start: i for i, start in enumerate(starts) }
+    delta = n_old - n_new
+    stop = None
+    tokens = []
+    for pos, ttype, value in Controller.regex_tokens(
+      lexer, text, starts[resume], stack
+    ):
+      if ttype is not None:
+        tokens.append((ttype, value))
+        continue
+      i = line_of.get(pos)
+      if i is None or i >= n_new or states[i] is not None:
+        continue
+      states[i] = value
+      if i > n_new - suffix and i > resume \
+        and starts[i] - starts[n_new - suffix] > lookbehind \
+        and old_states[i + delta] is not None \
+        and tuple(old_states[i + delta]) == value:
+        stop = i
+        break
+    if lexer.filters:
+      tokens = pyg_lexer.apply_filters(tokens, lexer.filters, lexer)
+    out = lazy_import('io').StringIO()
+    self.formatter.format(tokens, out)
+    lines += out.getvalue().split('\n')[:-1]
+    if stop is not None:
+      lines += old['lines'][stop + delta:]
+      states[stop:] = old_states[stop + delta:]
+    if self.arguments.debug:
+      print('RELEX', resume, n_new if stop is None else stop, n_new)
+    states = [list(state) if state else None for state in states]
+    try:
+      with AtomicFile(ckpt_p) as f:
+        json.dump({
+          'key': key,
+          'hashes': hashes,
+          'states': states,
+          'lines': lines,
+        }, f)
+    except OSError:
+      pass
+    return lines
+  @staticmethod
+  def stream_sample(path):
+    with open(path, 'r', encoding='utf-8') as f:
+      head = f.read(Controller.GUESS_SIZE)
+      if not f.read(1):
+        return head
+    with open(path, 'rb') as f:
+      f.seek(-Controller.GUESS_SIZE, os.SEEK_END)
+      tail = f.read().decode('utf-8', 'ignore')
+    return head + '\n' + tail.rstrip().rsplit('\n', 1)[-1]
+  STREAM_LINES = 1000
+  def stream_bounds(self, path):
+    lexer = self.lexer
+    first = last = None
+    with open(path, 'r', encoding='utf-8') as f:
+      for i, line in enumerate(f):
+        if i == 0 and line.startswith('\ufeff'):
+          line = line[1:]
+        if lexer.stripall:
+          blank = not line.strip()
+        elif lexer.stripnl:
+          blank = not line.strip('\n')
+        else:
+          blank = not line
+        if not blank:
+          if first is None:
+            first = i
+          last = i
+    return first, last
+  def stream_lines(self, path, bounds):
+    lexer = self.lexer
+    first, last = bounds
+    if first is None:
+      if lexer.ensurenl:
+        yield '\n'
+      return
+    with open(path, 'r', encoding='utf-8') as f:
+      for i, line in enumerate(f):
+        if i == 0 and line.startswith('\ufeff'):
+          line = line[1:]
+        if i < first:
+          continue
+        if lexer.stripall:
+          if i == first:
+            line = line.lstrip()
+          if i == last:
+            line = line.rstrip()
+        elif lexer.stripnl and i == last:
+          line = line.rstrip('\n')
+        if lexer.tabsize > 0:
+          line = line.expandtabs(lexer.tabsize)
+        if i == last:
+          if lexer.ensurenl and not line.endswith('\n'):
+            line += '\n'
+          yield line
+          return
+        yield line
+  def stream_bounded(self):
+    lexer = self.lexer
+    get_tokens_unprocessed = type(lexer).get_tokens_unprocessed
+    if get_tokens_unprocessed \
+      is lazy_import('pygments.lexers.special').TextLexer.get_tokens_unprocessed:
+      return None
+    return get_tokens_unprocessed \
+      is lazy_import('pygments.lexer').RegexLexer.get_tokens_unprocessed \
+      and Controller.lexer_bounds(lexer)[0]
+  def stream_tokens(self, lines):
+    lexer = self.lexer
+    itertools = lazy_import('itertools')
+    bounded = self.stream_bounded()
+    if bounded is None:
+      lines = iter(lines)
+      while True:
+        chunk = ''.join(itertools.islice(lines, Controller.STREAM_LINES))
+        if not chunk:
+          return
+        yield lazy_import('pygments.token').Text, chunk
+    if not bounded:
+      for _, ttype, value in lexer.get_tokens_unprocessed(''.join(lines)):
+        yield ttype, value
+      return
+    _, lookbehind, _ = Controller.lexer_bounds(lexer)
+    lookbehind = max(lookbehind, 1)
+    size = Controller.STREAM_LINES
+    lines = iter(lines)
+    stack = ('root',)
+    head = ''
+    window = []
+    done = False
+    while not done:
+      chunk = list(itertools.islice(lines, size))
+      done = len(chunk) < size
+      window += chunk
+      if not window:
+        break
+      text = head + ''.join(window)
+      line_of = {}
+      pos = len(head)
+      for i, line in enumerate(window):
+        line_of[pos] = i
+        pos += len(line)
+      tokens = []
+      cut = None
+      for pos, ttype, value in Controller.regex_tokens(
+        lexer, text, len(head), stack
+      ):
+        if ttype is not None:
+          tokens.append((ttype, value))
+        elif not done and pos > len(head) and pos in line_of:
+          cut = len(tokens), pos, value
+      if done:
+        yield from tokens
+        break
+      if cut is None:
+        continue
+      n, pos, stack = cut
+      yield from tokens[:n]
+      head = text[max(pos - lookbehind, 0):pos]
+      window = window[line_of[pos]:]
+  def pygmentize_stream(self, path, outfile):
+    if self.stream_bounded() is False:
+      Controller.lua_debug(
+        f'coder-tool: the {self.lexer.name} lexer is not line bounded,'
+        f' {path} is lexed at once'
+      )
+    bounds = self.stream_bounds(path)
+    last = sum(line.endswith('\n') for line in self.stream_lines(path, bounds))
+    self.pygmentize_lines(self.stream_lines(path, bounds), last, outfile)
+  def line_range(self, count):
+    fv_opts = self.fv_opts
+    try:
+      first = max(int(fv_opts.firstline or 1), 1)
+      last = min(int(fv_opts.lastline or count), count)
+    except ValueError:
+      return None
+    if last < first or first == 1 and last == count:
+      return None
+    return first, last
+  def pygmentize_lines(self, lines, count, outfile):
+    lexer = self.lexer
+    outfile.write(self.setup(count))
+    span = self.line_range(count)
+    if span is None:
+      line, first, last = 1, 1, None
+      tokens = self.stream_tokens(lines)
+    else:
+      first, last = span
+      line, tokens = self.span_tokens(lines, first, last)
+    if lexer.filters:
+      tokens = lazy_import('pygments.lexer').apply_filters(
+        tokens, lexer.filters, lexer
+      )
+    if last is not None:
+      tokens = Controller.tokens_until(tokens, line, last)
+    writer = CDRWriter(outfile, False, line, first, last)
+    self.formatter.format(tokens, writer)
+    writer.close()
+  def span_tokens(self, lines, first, last):
+    lexer = self.lexer
+    pyg_lexer = lazy_import('pygments.lexer')
+    if type(lexer).get_tokens_unprocessed \
+      is not pyg_lexer.RegexLexer.get_tokens_unprocessed \
+      or any(type(f).__name__ != 'GobbleFilter' for f in lexer.filters) \
+      or not Controller.lexer_bounds(lexer)[2]:
+      return 1, self.stream_tokens(lines)
+    itertools = lazy_import('itertools')
+    lookbehind = max(Controller.lexer_bounds(lexer)[1], 1)
+    lines = iter(lines)
+    head = ''
+    for line in itertools.islice(lines, first - 1):
+      head = (head + line)[-lookbehind:]
+    text = head + ''.join(itertools.islice(lines, last - first + 2))
+    return first, (
+      (ttype, value) for _, ttype, value in Controller.regex_tokens(
+        lexer, text, len(head), ('root',)
+      ) if ttype is not None
+    )
+  @staticmethod
+  def tokens_until(tokens, line, last):
+    for ttype, value in tokens:
+      yield ttype, value
+      line += value.count('\n')
+      if line > last:
+        return
+  def types_writer(self, outfile, types):
+    findall = Controller.lru_cached(
+      'types_pattern', self.pygopts.commandprefix
+    ).findall
+    def post(text):
+      types.update(findall(text))
+      return text
+    return PostWriter(outfile, post)
   def create_pygmented(self):
     args = self.arguments
     base = args.base
     if not base:
       return False
+    Path = lazy_import('pathlib').Path
+    ns = self.ns
+    if ns.stream and not self.texopts.is_inline:
+      self.tick('load')
+      if self.pygopts.lang == 'auto':
+        self.guess(Controller.stream_sample(ns.stream))
+      styles = set()
+      with AtomicFile(Path(base).with_suffix('.pyg.tex')) as f:
+        if ns.report_types:
+          f = self.types_writer(f, styles)
+        self.pygmentize_stream(ns.stream, f)
+      if ns.report_types:
+        Controller.lua_types(Path(base).name, styles)
+      self.tick('hilight')
+      self.stats_flush()
+      return
     source = args.source
     if not source:
       tex_p = Path(base).with_suffix('.tex')
@@ -340,17 +1508,774 @@ file name with extension, contains processing information.
         source = f.read()
     if args.debug:
       print('SOURCE', source)
+    self.guess(source)
     pyg_tex_p = Path(base).with_suffix('.pyg.tex')
+    self.tick('load')
+    if ns.stats:
+      self.lexer
+      self.tick('lexer')
+      self.formatter
+      self.tick('formatter')
+    if not (args.debug or ns.print_tex or ns.store or ns.pack):
+      styles = set()
+      with AtomicFile(pyg_tex_p) as f:
+        if ns.report_types:
+          f = self.types_writer(f, styles)
+        self.pygmentize(source, f)
+      if ns.report_types:
+        Controller.lua_types(Path(base).name, styles)
+      self.tick('hilight')
+      self.stats_flush()
+      return
     hilighted = self.pygmentize(source)
-    with pyg_tex_p.open(mode='w',encoding='utf-8') as f:
-      f.write(hilighted)
+    self.tick('hilight')
+    if ns.report_types:
+      Controller.lua_types(Path(base).name, Controller.lru_cached(
+        'types_pattern', self.pygopts.commandprefix
+      ).findall(hilighted))
+    packed = None
+    if ns.pack:
+      fp = Path(base).name
+      try:
+        packed = Controller.pack_append(ns.pack, fp, hilighted)
+      except OSError as err:
+        sys.stderr.write(f'{ns.pack}: {err}\n')
+    if packed:
+      Controller.lua_pack(fp, *packed)
+    else:
+      with AtomicFile(pyg_tex_p) as f:
+        f.write(hilighted)
     if args.debug:
       print('HILIGHTED', os.path.relpath(pyg_tex_p), hilighted)
+    if ns.print_tex:
+      Controller.lua_tex(hilighted)
+    self.tick('write')
+    if ns.store:
+      Controller.store_put(
+        ns.store, Path(base).name, hilighted, ns.store_size * 1024 * 1024
+      )
+      self.tick('store')
+    self.stats_flush()
+  _store_connections = {}
+  @staticmethod
+  def store_connect(store):
+    db = Controller._store_connections.get(store)
+    if db is None:
+      sqlite3 = lazy_import('sqlite3')
+      os.makedirs(store, exist_ok=True)
+      db = sqlite3.connect(
+        os.path.join(store, 'index.sqlite'),
+        timeout = 60,
+        isolation_level = None,
+      )
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('''
+CREATE TABLE IF NOT EXISTS objects (
+  fingerprint TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  used REAL NOT NULL
+)''')
+      Controller._store_connections[store] = db
+    return db
+  @staticmethod
+  def store_object_path(store, fp):
+    return os.path.join(store, 'objects', fp[:2], f'{fp}.pyg.tex')
+  @staticmethod
+  def store_put(store, fp, contents, budget):
+    try:
+      object_p = Controller.store_object_path(store, fp)
+      os.makedirs(os.path.dirname(object_p), exist_ok=True)
+      data = contents.encode('utf-8')
+      with AtomicFile(object_p, 'wb') as f:
+        f.write(data)
+      db = Controller.store_connect(store)
+      db.execute(
+        'INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+        (fp, len(data), time.time())
+      )
+      total, = db.execute('SELECT TOTAL(size) FROM objects').fetchone()
+      if total > budget:
+        Controller.store_evict(store, budget)
+    except Exception as err:
+      Controller.lua_debug(f'coder-tool store error: {err}')
+  @staticmethod
+  def store_evict(store, budget):
+    db = Controller.store_connect(store)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+      rows = []
+      total = 0
+      for fp, size, used in db.execute(
+        'SELECT fingerprint, size, used FROM objects'
+      ).fetchall():
+        try:
+          used = max(
+            used, os.path.getmtime(Controller.store_object_path(store, fp))
+          )
+        except OSError:
+          db.execute('DELETE FROM objects WHERE fingerprint = ?', (fp,))
+          continue
+        rows.append((used, fp, size))
+        total += size
+      rows.sort()
+      target = 0.9 * budget
+      for used, fp, size in rows:
+        if total <= target:
+          break
+        try:
+          os.remove(Controller.store_object_path(store, fp))
+        except OSError:
+          pass
+        db.execute('DELETE FROM objects WHERE fingerprint = ?', (fp,))
+        total -= size
+      db.execute('COMMIT')
+    except BaseException:
+      db.execute('ROLLBACK')
+      raise
+  PACK_NAME = 'snippets.pyg.pack'
+  @staticmethod
+  def pack_append(pack_p, fp, contents):
+    data = contents.encode('utf-8')
+    with FileLock(pack_p):
+      with open(pack_p, 'ab') as f:
+        offset = f.seek(0, os.SEEK_END)
+        f.write(data)
+      with open(f'{pack_p}.tsv', 'a', encoding='utf-8') as f:
+        f.write(f'{fp}\t{offset}\t{len(data)}\n')
+    return offset, len(data)
+  @staticmethod
+  def pack_index(pack_p):
+    index = {}
+    try:
+      with open(f'{pack_p}.tsv', 'r', encoding='utf-8') as f:
+        for line in f:
+          fp, _, rest = line.rstrip('\n').partition('\t')
+          offset, _, length = rest.partition('\t')
+          if offset.isdigit() and length.isdigit():
+            index[fp] = (int(offset), int(length))
+    except OSError:
+      pass
+    return index
+  @staticmethod
+  def pack_compact(pack_p, evicted=(), transform=None):
+    with FileLock(pack_p):
+      index = Controller.pack_index(pack_p)
+      lines = []
+      with open(pack_p, 'rb') as src, AtomicFile(pack_p, 'wb') as dst:
+        offset = 0
+        for fp, (start, length) in sorted(index.items(), key=lambda x: x[1]):
+          if fp in evicted:
+            continue
+          src.seek(start)
+          data = src.read(length)
+          if transform:
+            data = transform(data)
+            length = len(data)
+          dst.write(data)
+          lines.append(f'{fp}\t{offset}\t{length}\n')
+          offset += length
+      with AtomicFile(f'{pack_p}.tsv') as f:
+        f.writelines(lines)
+  def serve(self):
+    json = lazy_import('json')
+    shlex = lazy_import('shlex')
+    pending = [lang.strip() for lang in (self.ns.preload or '').split(',')]
+    pending = [lang for lang in pending if lang and lang != 'auto']
+    fd = sys.stdin.fileno()
+    buffer = b''
+    with open(self.ns.serve, 'wb') as fifo:
+      while True:
+        while b'\n' not in buffer:
+          if pending and Controller.serve_idle(fd):
+            Controller.preload(pending[:1])
+            pending = pending[1:]
+            if not pending:
+              gc = lazy_import('gc')
+              if hasattr(gc, 'freeze'):
+                gc.freeze()
+            continue
+          chunk = os.read(fd, 65536)
+          if not chunk:
+            break
+          buffer += chunk
+        if not buffer:
+          break
+        line, _, buffer = buffer.partition(b'\n')
+        line = line.decode('utf-8')
+        arguments = None
+        if line.startswith('{'):
+          entry = json.loads(line, object_hook = Controller.object_hook)
+          line = entry.argv
+          arguments = entry.arguments
+        argv = shlex.split(line)
+        if not argv:
+          continue
+        Controller.serve_respond(fifo, Controller.serve_request(argv, arguments))
+  @staticmethod
+  def serve_request(argv, arguments):
+    out = lazy_import('io').StringIO()
+    with lazy_import('contextlib').redirect_stdout(out):
+      try:
+        ctrl = Controller(argv, arguments)
+        ctrl.create_style() or ctrl.create_pygmented()
+      except SystemExit:
+        pass
+      except Exception as err:
+        Controller.lua_debug(f'coder-tool server error: {err}')
+    return out.getvalue().encode('utf-8')
+  @staticmethod
+  def serve_respond(fifo, response):
+    fifo.write(f'{len(response)}\n'.encode('ascii'))
+    fifo.write(response)
+    fifo.flush()
+  @staticmethod
+  def serve_idle(fd):
+    try:
+      ready, _, _ = lazy_import('select').select([fd], [], [], 0)
+    except (OSError, ValueError):
+      return None
+    return not ready
+  PRELOAD_MODULES = (
+    'argparse', 'contextlib', 'hashlib', 'io', 'itertools', 'pathlib',
+    'pygments', 'pygments.formatters.latex', 'pygments.lexer',
+    'pygments.token', 'pygments.util',
+  )
+  @staticmethod
+  def preload(languages):
+    for name in Controller.PRELOAD_MODULES:
+      lazy_import(name)
+    pygopts = PygOpts()
+    fv_opts = FVOpts()
+    formatter = Controller.lru_cached(
+      'make_formatter',
+      pygopts.style,
+      pygopts.commandprefix,
+      pygopts.texcomments,
+      pygopts.mathescape,
+      pygopts.escapeinside,
+      pygopts.nobackground,
+      pygopts.wrap,
+    )
+    for lang in languages:
+      lang = lang.strip()
+      if not lang or lang == 'auto':
+        continue
+      try:
+        Controller.lexer_by_name(lang)
+        lexer = Controller.lru_cached(
+          'make_lexer',
+          lang,
+          pygopts.escapeinside,
+          fv_opts.gobble,
+          fv_opts.tabsize,
+        )
+      except Exception:
+        continue
+      formatter.format(lexer.get_tokens('\n'), lazy_import('io').StringIO())
+      if hasattr(lexer, '_tokens'):
+        Controller.lexer_bounds(lexer)
+  @staticmethod
+  def build(argv):
+    json = lazy_import('json')
+    parser = lazy_import('argparse').ArgumentParser(
+      prog=f'{sys.argv[0]} build',
+      description='''
+Process all the hilighting requests listed in a manifest
+written by a LuaLaTeX run in manifest mode.
+'''
+    )
+    parser.add_argument(
+      "-j", "--jobs",
+      action='store',
+      type=int,
+      default=os.cpu_count(),
+      help="the number of processes, defaults to the number of cores"
+    )
+    parser.add_argument(
+      "manifest",
+      metavar="<manifest>",
+      help="the manifest file, in general <jobname>.pygd/manifest.pyg.jsonl"
+    )
+    ns = parser.parse_args(argv)
+    requests = {}
+    with open(ns.manifest, 'r', encoding='utf-8') as f:
+      for line in f:
+        if not line.strip():
+          continue
+        entry = json.loads(line, object_hook = Controller.object_hook)
+        texopts = entry.arguments.texopts
+        key = (
+          entry.directory,
+          str(texopts.pyg_sty_p) if '--create_style' in entry.argv else '',
+          Controller.build_base(entry.argv),
+        )
+        requests.setdefault(key, line)
+    lines = list(requests.values())
+    if lines:
+      entry = json.loads(lines[0], object_hook = Controller.object_hook)
+      Controller.build_salt(
+        lazy_import('pathlib').Path(entry.directory) / entry.index,
+        entry.salt
+      )
+    if not lines:
+      print(f'{sys.argv[0]}: nothing to build')
+      return 0
+    jobs = max(1, ns.jobs or 1)
+    chunksize = max(1, len(lines) // (4 * jobs))
+    futures = lazy_import('concurrent.futures')
+    with futures.ProcessPoolExecutor(max_workers = jobs) as executor:
+      for out in executor.map(
+        Controller.build_entry, lines, chunksize = chunksize
+      ):
+        if out:
+          print(out, end='')
+    print(f'{sys.argv[0]}: {len(lines)} requests built')
+    return 0
+  @staticmethod
+  def build_salt(index_p, salt):
+    current = Controller.salt()
+    if salt == current:
+      return
+    lines = []
+    if index_p.exists():
+      with open(index_p, 'r', encoding='utf-8') as f:
+        for l in f:
+          if l.startswith('#style:'):
+            lines.append(l)
+    with AtomicFile(index_p) as f:
+      f.write(f'#salt\t{current}\n')
+      f.writelines(lines)
+  @staticmethod
+  def build_base(arguments):
+    for arg in lazy_import('shlex').split(arguments):
+      if arg.startswith('--base='):
+        return arg[7:]
+    return ''
+  @staticmethod
+  def build_argv(entry):
+    argv = lazy_import('shlex').split(entry.argv)
+    salt = Controller.salt()
+    key = getattr(entry, 'key', None)
+    if not key or entry.salt == salt:
+      return argv
+    fp = lazy_import('hashlib').md5(
+      f'{salt}\n{key}'.encode('utf-8')
+    ).hexdigest()
+    for i, arg in enumerate(argv):
+      if arg.startswith('--base='):
+        argv[i] = '--base=' + os.path.join(os.path.dirname(arg[7:]), fp)
+    return argv
+  @staticmethod
+  def build_entry(line):
+    json = lazy_import('json')
+    entry = json.loads(line, object_hook = Controller.object_hook)
+    os.chdir(entry.directory)
+    out = lazy_import('io').StringIO()
+    with lazy_import('contextlib').redirect_stdout(out):
+      try:
+        ctrl = Controller(Controller.build_argv(entry), entry.arguments)
+        ctrl.create_style() or ctrl.create_pygmented()
+      except SystemExit:
+        pass
+      except Exception as err:
+        print(f'{sys.argv[0]} build: {err}')
+    return out.getvalue()
+  GC_LOCK_AGE = 600
+  GC_SUFFIXES = ('.pyg.tex', '.pyg.sty', '.pyg.ckpt')
+  @staticmethod
+  def gc(argv):
+    parser = lazy_import('argparse').ArgumentParser(
+      prog=f'{sys.argv[0]} gc',
+      description='''
+Evict from the cache directories the hilighted snippets and styles
+not used for too long, then the least recently used ones
+until the size budget is met.
+'''
+    )
+    parser.add_argument(
+      "--max-age",
+      action='store',
+      type=float,
+      default=30,
+      metavar="<days>",
+      help="evict the files not used for that many days, defaults to 30"
+    )
+    parser.add_argument(
+      "--max-size",
+      action='store',
+      type=float,
+      default=None,
+      metavar="<megabytes>",
+      help="the size budget of all the cache directories, no limit by default"
+    )
+    parser.add_argument(
+      "--grace",
+      action='store',
+      type=float,
+      default=10,
+      metavar="<minutes>",
+      help="never evict the files modified that recently, defaults to 10"
+    )
+    parser.add_argument(
+      "-n", "--dry-run",
+      action='store_true',
+      default=None,
+      help="only report what would be evicted"
+    )
+    parser.add_argument(
+      "path",
+      metavar="<path>",
+      nargs='*',
+      help="cache directories or directories containing them,"
+      " defaults to the current directory"
+    )
+    ns = parser.parse_args(argv)
+    with lazy_import('contextlib').ExitStack() as stack:
+      now = time.time()
+      files = []
+      packs = {}
+      total = 0
+      for pygd_p in Controller.gc_directories(ns.path or ['.']):
+        if Controller.gc_busy(pygd_p, now, ns.dry_run):
+          print(f'{pygd_p}: in use, skipped')
+          continue
+        lock = stack.enter_context(
+          FileLock(os.path.join(pygd_p, 'gc'), timeout=0)
+        )
+        if not lock.locked:
+          print(f'{pygd_p}: gc in progress, skipped')
+          continue
+        used = Controller.gc_used(pygd_p)
+        pack_p = os.path.join(pygd_p, Controller.PACK_NAME)
+        try:
+          st = os.stat(pack_p)
+        except OSError:
+          st = None
+        if st:
+          total += st.st_size
+          dead = st.st_size
+          for fp, (_, size) in Controller.pack_index(pack_p).items():
+            dead -= size
+            t = used.get(f'{fp}.pyg.tex', st.st_mtime)
+            if now - t < 60 * ns.grace:
+              continue
+            files.append((t, size, pack_p, pygd_p, fp))
+          packs[pack_p] = (pygd_p, max(dead, 0))
+        for entry in os.scandir(pygd_p):
+          if not entry.name.endswith(Controller.GC_SUFFIXES):
+            continue
+          try:
+            st = entry.stat()
+          except OSError:
+            continue
+          total += st.st_size
+          if now - st.st_mtime < 60 * ns.grace:
+            continue
+          files.append((
+            max(used.get(entry.name, 0), st.st_mtime),
+            st.st_size,
+            entry.path,
+            pygd_p,
+            None,
+          ))
+      files.sort(key=lambda file: file[:3])
+      max_age = now - 24 * 3600 * ns.max_age
+      budget = None if ns.max_size is None else ns.max_size * 1024 * 1024
+      reclaimed = {}
+      evicted = {}
+      for used, size, path, pygd_p, fp in files:
+        if used > max_age and (budget is None or total <= budget):
+          break
+        if fp is not None:
+          evicted.setdefault(path, set()).add(fp)
+        elif not ns.dry_run:
+          try:
+            os.remove(path)
+          except OSError:
+            continue
+        total -= size
+        n, b = reclaimed.get(pygd_p, (0, 0))
+        reclaimed[pygd_p] = (n + 1, b + size)
+      for pack_p, (pygd_p, dead) in packs.items():
+        if not dead and pack_p not in evicted:
+          continue
+        if not ns.dry_run:
+          try:
+            Controller.pack_compact(pack_p, evicted.get(pack_p, ()))
+          except OSError:
+            continue
+        total -= dead
+        n, b = reclaimed.get(pygd_p, (0, 0))
+        reclaimed[pygd_p] = (n, b + dead)
+      for pygd_p, (n, b) in sorted(reclaimed.items()):
+        print(f'{pygd_p}: {n} files, {b} bytes reclaimed')
+      n = sum(n for n, _ in reclaimed.values())
+      b = sum(b for _, b in reclaimed.values())
+      print(
+        f'{sys.argv[0]} gc: {n} files, {b} bytes reclaimed'
+        + (' (dry run)' if ns.dry_run else '')
+        + f', {total} bytes in use'
+      )
+      return 0
+  @staticmethod
+  def gc_busy(pygd_p, now, dry_run=False):
+    for entry in os.scandir(pygd_p):
+      if entry.name.endswith('.pyg.lock'):
+        try:
+          if now - entry.stat().st_mtime < Controller.GC_LOCK_AGE:
+            return True
+          if not dry_run:
+            os.remove(entry.path)
+        except OSError:
+          pass
+    return False
+  @staticmethod
+  def gc_directories(paths):
+    for path in paths:
+      if path.endswith('.pygd') and os.path.isdir(path):
+        yield path
+        continue
+      for root, dirs, _ in os.walk(path):
+        for d in dirs:
+          if d.endswith('.pygd'):
+            yield os.path.join(root, d)
+        dirs[:] = [d for d in dirs if not d.endswith('.pygd')]
+  @staticmethod
+  def gc_used(pygd_p):
+    used = {}
+    try:
+      with open(
+        os.path.join(pygd_p, 'used.pyg.tsv'), 'r', encoding='utf-8'
+      ) as f:
+        for line in f:
+          name, _, t = line.rstrip('\n').partition('\t')
+          if t.isdigit():
+            used[name] = int(t)
+    except OSError:
+      pass
+    return used
+  POSTPROCESS_SUFFIXES = ('.pyg.tex', '.pygtex', '.pyg.pack')
+  @staticmethod
+  def postprocess(argv):
+    parser = lazy_import('argparse').ArgumentParser(
+      prog=f'{sys.argv[0]} postprocess',
+      description='''
+Wrap the given commands into macros in already hilighted files,
+in one pass per file.
+'''
+    )
+    parser.add_argument(
+      "-w", "--wrap",
+      action='append',
+      required=True,
+      metavar="<wrapper>:<command>,...",
+      help="wrap each command into the wrapper macro,"
+      " can be repeated, or separated by ';'"
+    )
+    parser.add_argument(
+      "--commandprefix",
+      action='store',
+      default=PygOpts.commandprefix,
+      metavar="<prefix>",
+      help=f"the prefix of the pygments macros, defaults to {PygOpts.commandprefix},"
+      " PYG for minted"
+    )
+    parser.add_argument(
+      "-j", "--jobs",
+      action='store',
+      type=int,
+      default=os.cpu_count(),
+      help="the number of processes, defaults to the number of cores"
+    )
+    parser.add_argument(
+      "-n", "--dry-run",
+      action='store_true',
+      default=None,
+      help="only report what would be changed"
+    )
+    parser.add_argument(
+      "path",
+      metavar="<path>",
+      nargs='*',
+      help="files or directories containing them,"
+      " defaults to the current directory"
+    )
+    ns = parser.parse_args(argv)
+    wrap = ';'.join(ns.wrap)
+    if not Controller.wrap_table(wrap):
+      parser.error(f'nothing to wrap: {wrap}')
+    paths = []
+    for path in ns.path or ['.']:
+      if not os.path.isdir(path):
+        paths.append(path)
+        continue
+      for root, _, files in os.walk(path):
+        paths.extend(
+          os.path.join(root, f) for f in sorted(files)
+          if f.endswith(Controller.POSTPROCESS_SUFFIXES)
+        )
+    changed = 0
+    if paths:
+      jobs = max(1, ns.jobs or 1)
+      chunksize = max(1, len(paths) // (4 * jobs))
+      futures = lazy_import('concurrent.futures')
+      with futures.ProcessPoolExecutor(max_workers = jobs) as executor:
+        for path, done in zip(paths, executor.map(
+          lazy_import('functools').partial(
+            Controller.postprocess_file,
+            commandprefix = ns.commandprefix,
+            wrap = wrap,
+            dry_run = ns.dry_run,
+          ),
+          paths,
+          chunksize = chunksize,
+        )):
+          if done:
+            changed += 1
+            print(f'{path}: changed')
+    print(
+      f'{sys.argv[0]} postprocess: {changed} files changed'
+      + (' (dry run)' if ns.dry_run else '')
+      + f', {len(paths) - changed} unchanged'
+    )
+    return 0
+  @staticmethod
+  def postprocess_file(path, commandprefix, wrap, dry_run):
+    post = Controller.lru_cached('make_post', commandprefix, wrap)
+    try:
+      if path.endswith('.pyg.pack'):
+        with open(path, 'rb') as f:
+          for start, length in Controller.pack_index(path).values():
+            f.seek(start)
+            text = f.read(length).decode('utf-8')
+            if post(text) != text:
+              break
+          else:
+            return False
+        if not dry_run:
+          Controller.pack_compact(
+            path,
+            transform = lambda data: post(data.decode('utf-8')).encode('utf-8')
+          )
+        return True
+      with open(path, 'r', encoding='utf-8', newline='') as f:
+        text = f.read()
+      new = post(text)
+      if new == text:
+        return False
+      if not dry_run:
+        Controller.write_if_changed(path, new)
+      return True
+    except (OSError, UnicodeDecodeError) as err:
+      sys.stderr.write(f'{path}: {err}\n')
+      return False
+  @staticmethod
+  def export(argv):
+    parser = lazy_import('argparse').ArgumentParser(
+      prog=f'{sys.argv[0]} export',
+      description='''
+Build the files exported by a document, from the records of the tagged
+code blocks.
+'''
+    )
+    parser.add_argument(
+      "json",
+      metavar="<json data file>",
+      help="the exportations, in general <jobname>.pygd/input.pyg.json"
+    )
+    ns = parser.parse_args(argv)
+    with open(ns.json, 'r', encoding='utf-8') as f:
+      data = lazy_import('json').load(
+        f,
+        object_hook = Controller.object_hook
+      )
+    records = []
+    by_tag = {}
+    if data.records:
+      with open(data.records, 'rb') as f:
+        s = f.read()
+      i = 0
+      while True:
+        j = s.find(b'\n', i)
+        if j < 0:
+          break
+        tags, _, n = s[i:j].partition(b'\t')
+        if not n.isdigit():
+          break
+        i = j + 1 + int(n)
+        records.append(s[j+1:i].decode('utf-8'))
+        i += 1
+        for tag in tags.decode('utf-8').split(','):
+          if tag:
+            by_tag.setdefault(tag, []).append(len(records) - 1)
+    written = 0
+    already_by_file = {}
+    for export in data.exports:
+      lines = list(getattr(export, 'preamble', None) or [])
+      already = already_by_file.setdefault(export.file, set())
+      for tag in export.tags.split(','):
+        for i in by_tag.get(tag, ()):
+          if not export.once or i not in already:
+            lines.append(records[i])
+          if export.once:
+            already.add(i)
+      lines += getattr(export, 'postamble', None) or []
+      if lines:
+        if lines[-1]:
+          lines.append('')
+        if Controller.write_if_changed(export.file, '\n'.join(lines)):
+          written += 1
+    print(
+      f'{sys.argv[0]} export: {written} files written,'
+      f' {len(data.exports) - written} unchanged'
+    )
+    return 0
+  @staticmethod
+  def write_if_changed(path, contents):
+    data = contents.encode('utf-8')
+    try:
+      with open(path, 'rb') as f:
+        if f.read() == data:
+          return False
+    except OSError:
+      pass
+    with AtomicFile(path, 'wb') as f:
+      f.write(data)
+    return True
+  @staticmethod
+  def startup_report():
+    total = time.perf_counter() - _startup_time
+    lines = [f'{sys.argv[0]}: startup report (ms)']
+    for name, t in sorted(
+      _import_times.items(), key = lambda item: -item[1]
+    ):
+      lines.append(f'{1000 * t:9.2f}  {name}')
+    lines.append(f'{1000 * sum(_import_times.values()):9.2f}  imports')
+    lines.append(f'{1000 * total:9.2f}  total')
+    sys.stderr.write('\n'.join(lines) + '\n')
 if __name__ == '__main__':
+  sys.stdout.reconfigure(encoding='utf-8', newline='\n')
   try:
+    if sys.argv[1:2] == ['build']:
+      sys.exit(Controller.build(sys.argv[2:]))
+    if sys.argv[1:2] == ['styles']:
+      sys.exit(Controller.styles(sys.argv[2:]))
+    if sys.argv[1:2] == ['gc']:
+      sys.exit(Controller.gc(sys.argv[2:]))
+    if sys.argv[1:2] == ['export']:
+      sys.exit(Controller.export(sys.argv[2:]))
+    if sys.argv[1:2] == ['postprocess']:
+      sys.exit(Controller.postprocess(sys.argv[2:]))
+    t = time.perf_counter()
     ctrl = Controller()
+    if ctrl.ns.serve:
+      sys.exit(ctrl.serve())
+    if ctrl.stats is not None:
+      ctrl.stats = dict(startup = t - _startup_time, **ctrl.stats)
     x = ctrl.create_style() or ctrl.create_pygmented()
     print(f'{sys.argv[0]}: done')
+    if ctrl.ns.startup_report:
+      Controller.startup_report()
     sys.exit(x)
   except KeyboardInterrupt:
     sys.exit(1)
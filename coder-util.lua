@@ -33,8 +33,12 @@ local function set_python_path(self, path_var)
     print('**** CDR mode', path, mode)
   end
   if not mode then
-    path = io.popen([[which python]]):read('a'):match("^%s*(.-)%s*$")
-    mode,_,__ = lfs.attributes(path,'mode')
+    local pipe = io.popen([[which python]])
+    if pipe then
+      path = pipe:read('a'):match("^%s*(.-)%s*$")
+      pipe:close()
+      mode,_,__ = lfs.attributes(path,'mode')
+    end
     print('**** CDR mode', path, mode)
   end
   if mode == 'file' or mode == 'link' then
@@ -92,14 +96,64 @@ local function make_directory(path)
   end
   return nil,path.." exist and is not a directory",1
 end
-local dir_p, json_p
+local dir_p, json_p, manifest_p, index_p, used_p, lock_p, records_p, pack_p
 local jobname = tex.jobname
+local uid = os.tmpname()
+os.remove(uid)
+uid = md5.sumhexa(uid..os.time()):sub(1, 12)
 dir_p = './'..jobname..'.pygd/'
 if make_directory(dir_p) == nil then
   dir_p = './'
-  json_p = dir_p..jobname..'.pyg.json'
+  json_p = dir_p..jobname..'-'..uid..'.pyg.json'
+  manifest_p = dir_p..jobname..'.pyg.manifest'
+  index_p = dir_p..jobname..'.pyg.index'
+  used_p = dir_p..jobname..'.pyg.used'
+  lock_p = dir_p..jobname..'-'..uid..'.pyg.lock'
+  records_p = dir_p..jobname..'-'..uid..'.pyg.records'
+  pack_p = dir_p..jobname..'.pyg.pack'
 else
-  json_p = dir_p..'input.pyg.json'
+  json_p = dir_p..'input-'..uid..'.pyg.json'
+  manifest_p = dir_p..'manifest.pyg.jsonl'
+  index_p = dir_p..'index.pyg.tsv'
+  used_p = dir_p..'used.pyg.tsv'
+  lock_p = dir_p..uid..'.pyg.lock'
+  records_p = dir_p..'records-'..uid..'.pyg.txt'
+  pack_p = dir_p..'snippets.pyg.pack'
+end
+local function write_atomic(p, contents, mode)
+  local tmp_p = p..'.'..uid..'.tmp'
+  local fh = io.open(tmp_p, mode or 'w')
+  if not fh then
+    return
+  end
+  local ok = fh:write(contents)
+  fh:close()
+  if ok and (os.rename(tmp_p, p) or os.remove(p) and os.rename(tmp_p, p)) then
+    return true
+  end
+  os.remove(tmp_p)
+end
+local function lock_acquire(p)
+  local lock_p = p..'.lock'
+  local tmp_p = lock_p..'.'..uid..'.tmp'
+  local fh = io.open(tmp_p, 'w')
+  if not fh then
+    return
+  end
+  fh:close()
+  local ok = lfs.link(tmp_p, lock_p)
+  if not ok then
+    local t = lfs.attributes(lock_p, 'modification')
+    if t and os.time() - t > 60 then
+      os.remove(lock_p)
+      ok = lfs.link(tmp_p, lock_p)
+    end
+  end
+  os.remove(tmp_p)
+  return ok and true
+end
+local function lock_release(p)
+  os.remove(p..'.lock')
 end
 local eq_pattern = P({ Cp() * P('=')^1 * Cp() + P(1) * V(1) })
 local function safe_equals(s)
@@ -131,33 +185,242 @@ local function load_exec(self, chunk)
     print('chunk:', chunk)
   end
 end
-local parse_pattern
-do
-  local tag = P('!') + '*' + '?'
-  local stp = '>>>>>'
-  local cmd = (P(1) - stp)^0
-  parse_pattern = P({
-    P('<<<<<') * Cg(tag) * 'LUA:' * Cg(cmd) * stp * Cp() + 1 * V(1)
-  })
-end
 local function load_exec_output(self, s)
-  local i, tag, cmd
-  i = 1
+  local i = 1
   while true do
-    tag, cmd, i = parse_pattern:match(s, i)
-    if tag == '!' then
-      self:load_exec(cmd)
-    elseif tag == '*' then
-      local eqs = safe_equals(cmd)
-      cmd = '['..eqs..'['..cmd..']'..eqs..']'
-      tex.print([[%
-\directlua{CDR:load_exec(]]..cmd..[[)}%
-]])
-    elseif tag == '?' then
-      print('\nDEBUG/coder: '..cmd)
-    else
+    local j = s:find('\1', i, true)
+    if not j then
       return
     end
+    local tag, n, k = s:match('^(.)(%d+)\n()', j + 1)
+    if tag then
+      local payload = s:sub(k, k + n - 1)
+      i = k + n
+      if tag == '!' then
+        self:load_exec(payload)
+      elseif tag == '*' then
+        local queue = self['.exec queue']
+        queue[#queue+1] = payload
+        tex.print([[\directlua{CDR:load_exec_next()}]])
+      elseif tag == '?' then
+        print('\nDEBUG/coder: '..payload)
+      elseif tag == 'T' then
+        self['.pyg_tex'] = payload
+      elseif tag == 'S' then
+        for phase, t in payload:gmatch('(%S+) (%S+)') do
+          self:stats_add(phase, tonumber(t))
+        end
+      elseif tag == 'P' then
+        local fp, offset, length = payload:match('^(%x+)\t(%d+)\t(%d+)$')
+        if fp then
+          self:pack_add(fp, tonumber(offset), tonumber(length))
+        end
+      elseif tag == 'L' then
+        local fp, lang = payload:match('^(%x+)\t(%S+)$')
+        if fp then
+          self:lang_add(fp, lang)
+        end
+      elseif tag == 'Y' then
+        local fp, types = payload:match('^(%x+)\t(.*)$')
+        if fp then
+          self:types_add(fp, types)
+        end
+      end
+    else
+      i = j + 1
+    end
+  end
+end
+local function load_exec_next(self)
+  local chunk = table.remove(self['.exec queue'], 1)
+  if chunk then
+    self:load_exec(chunk)
+  end
+end
+local function input_pyg_tex(self)
+  local reload = self['.style reload']
+  if reload then
+    self['.style reload'] = nil
+    tex.sprint(([[\CDR@StyleReload{%s}{%s}]]):format(reload[1], reload[2]))
+  end
+  local s = self['.pyg_tex']
+  if s then
+    self['.pyg_tex'] = nil
+    if s:sub(-1) ~= '\n' then
+      s = s..'\n'
+    end
+    local t = {}
+    for l in s:gmatch('(.-)\n') do
+      t[#t+1] = l
+    end
+    tex.print(t)
+  else
+    tex.print('\\input{'..token.get_macro('l_CDR_pyg_tex_tl')..'}')
+  end
+end
+local function server_start(self)
+  local server = self['.server']
+  if server ~= nil then
+    return server or nil
+  end
+  self['.server'] = false
+  if not self.use_server or os.type == 'windows' then
+    return
+  end
+  local fifo_p = os.tmpname()
+  os.remove(fifo_p)
+  os.execute(('mkfifo %q'):format(fifo_p))
+  if lfs.attributes(fifo_p, 'mode') ~= 'named pipe' then
+    return
+  end
+  local preload = ''
+  if self.preload ~= '' then
+    preload = (' --preload=%q'):format(self.preload)
+  end
+  local cmd = ('%s %s --serve=%q%s; : > %q'):format(
+    self.PYTHON_PATH, self.CDR_PY_PATH, fifo_p, preload, fifo_p
+  )
+  local pipe = io.popen(cmd, 'w')
+  if not pipe then
+    os.remove(fifo_p)
+    return
+  end
+  local fifo = io.open(fifo_p, 'rb')
+  if not fifo then
+    pipe:close()
+    os.remove(fifo_p)
+    return
+  end
+  server = {
+    pipe   = pipe,
+    fifo   = fifo,
+    fifo_p = fifo_p,
+  }
+  self['.server'] = server
+  return server
+end
+local function server_request(self, arguments, args)
+  local server = self:server_start()
+  if not server then
+    return
+  end
+  if args then
+    arguments = json.tostring({
+      argv      = arguments,
+      arguments = args,
+    })
+  end
+  server.pipe:write(arguments, '\n')
+  server.pipe:flush()
+  local n = tonumber(server.fifo:read('l'))
+  if n then
+    local o = n > 0 and server.fifo:read(n) or ''
+    if o then
+      return o
+    end
+  end
+  print('coder-util.lua: the coder-tool server is not available')
+  self:server_stop()
+  self['.server'] = false
+end
+local function server_stop(self)
+  local server = self['.server']
+  if server then
+    server.pipe:close()
+    server.fifo:close()
+    os.remove(server.fifo_p)
+  end
+  self['.server'] = nil
+end
+local function set_preload(self, languages_var)
+  local languages = assert(token.get_macro(languages_var))
+  local t = {}
+  for lang in languages:gmatch('[^,%s]+') do
+    t[#t+1] = lang
+  end
+  self.preload = table.concat(t, ',')
+end
+local function server_preload(self)
+  if self.preload ~= '' and self.PYTHON_PATH and not self.use_manifest then
+    self:server_start()
+  end
+end
+local function stats_add(self, phase, t)
+  local stats = self['.stats']
+  if not stats[phase] then
+    stats[#stats+1] = phase
+    stats[phase] = 0
+  end
+  stats[phase] = stats[phase] + t
+end
+local function stats_report(self)
+  local stats = self['.stats']
+  local calls = stats['.calls']
+  if not calls then
+    return
+  end
+  local wall = stats['.wall']
+  local t = {
+    ('coder-util.lua: %d call(s) to coder-tool, %.1f ms'):format(
+      calls, 1000 * wall
+    )
+  }
+  local other = wall
+  for _, phase in ipairs(stats) do
+    if phase:sub(1, 1) ~= '.' then
+      other = other - stats[phase]
+      t[#t+1] = ('%10.1f ms  %s'):format(1000 * stats[phase], phase)
+    end
+  end
+  t[#t+1] = ('%10.1f ms  %s'):format(
+    1000 * math.max(other, 0), 'other (python launch, pipes, json)'
+  )
+  print('\n'..table.concat(t, '\n'))
+end
+local function manifest_append(self, arguments, args, key)
+  local fh = self['.manifest']
+  if not fh then
+    fh = assert(io.open(self.manifest_p, 'w'))
+    self['.manifest'] = fh
+    self['.manifest count'] = 0
+    self:cache_record(nil, self.manifest_p)
+  end
+  fh:write(json.tostring({
+    argv      = arguments,
+    directory = lfs.currentdir(),
+    index     = self.index_p,
+    salt      = self:fingerprint_salt(),
+    key       = key,
+    arguments = args,
+  }), '\n')
+  self['.manifest count'] = self['.manifest count'] + 1
+end
+local function manifest_placeholder(self, name, contents)
+  local p = self.dir_p..name
+  if not lfs.attributes(p, 'mode') then
+    local fh = assert(io.open(p, 'w'))
+    fh:write(contents)
+    fh:close()
+  end
+  self:cache_record(nil, p)
+  return p
+end
+local function manifest_close(self)
+  local fh = self['.manifest']
+  if fh then
+    fh:close()
+    self['.manifest'] = nil
+    print(('\ncoder: %d pending hilighting requests, run:'):format(
+      self['.manifest count']
+    ))
+    print(('  %s %s build %s'):format(
+      self.PYTHON_PATH or 'python3',
+      self.CDR_PY_PATH or 'coder-tool.py',
+      self.manifest_p
+    ))
+    print('and typeset again.')
+  elseif self.use_manifest then
+    os.remove(self.manifest_p)
   end
 end
 local function hilight_set(self, key, value)
@@ -184,10 +447,12 @@ local function hilight_set_var(self, key, var)
   self:hilight_set(key, assert(token.get_macro(var or 'l_CDR_tl')))
 end
 local function hilight_source(self, sty, src)
-  if not self.PYTHON_PATH then
+  if not self.PYTHON_PATH and not self.use_manifest then
     return
   end
+  self:cache_lock()
   local args = self['.arguments']
+  self['.pyg_tex'] = nil
   local texopts = args.texopts
   texopts.synctex_tag  = self.synctex_tag
   texopts.synctex_line = self.synctex_line
@@ -195,27 +460,47 @@ local function hilight_source(self, sty, src)
   local inline = is_truthy(texopts.is_inline)
   local use_cache = is_truthy(args.cache)
   local use_py = false
-  local cmd = self.PYTHON_PATH..' '..self.CDR_PY_PATH
+  local cmd = ''
   local debug = is_truthy(args.debug)
   if debug then
     cmd = cmd..' --debug'
   end
-  local pyg_sty_p
+  local pyg_sty_p, sty_fp
   if sty then
     pyg_sty_p = self.dir_p..pygopts.style..'.pyg.sty'
     token.set_macro('l_CDR_pyg_sty_tl', pyg_sty_p)
     texopts.pyg_sty_p = pyg_sty_p
-    local mode,_,__ = lfs.attributes(pyg_sty_p, 'mode')
-    if not mode or not use_cache then
+    local types = not self.use_manifest
+      and self:style_types(pygopts.style) or nil
+    self['.style loaded'][pygopts.style] = types or true
+    local cached
+    repeat
+      sty_fp = self:fingerprint('style', types)
+      cached = use_cache and self:cache_lookup(sty_fp, pyg_sty_p)
+    until cached or not self:fingerprint_check()
+    if not cached then
       use_py = true
       if debug then
         print('PYTHON STYLE:')
       end
       cmd = cmd..(' --create_style')
+      if types then
+        cmd = cmd..(' --types=%q'):format(types)
+      end
+      if self.use_manifest then
+        token.set_macro('l_CDR_pyg_sty_tl', self:manifest_placeholder(
+          pygopts.style..'.pending.pyg.sty', ([[
+\makeatletter
+\CDR@StyleDefine{%s} {%%
+}%%
+\makeatother
+]]):format(pygopts.style)
+        ))
+      end
     end
     self:cache_record(pyg_sty_p)
   end
-  local pyg_tex_p
+  local pyg_tex_p, tex_fp, tex_key, stream_p
   if src then
     local source
     if inline then
@@ -224,57 +509,124 @@ local function hilight_source(self, sty, src)
       local ll = self['.lines']
       source = table.concat(ll, '\n')
     end
-    local hash = md5.sumhexa( ('%s:%s:%s'
-      ):format(
-        source,
-        inline and 'code' or 'block',
-        pygopts.style
+    local ckpt_p
+    if not inline then
+      local counts = self['.block counts']
+      local tag = texopts.synctex_tag or 0
+      counts[tag] = (counts[tag] or 0) + 1
+      if #self['.lines'] >= self.ckpt_lines then
+        ckpt_p = ('%sblock-%s-%d.pyg.ckpt'):format(self.dir_p, tag, counts[tag])
+        self:cache_record(nil, ckpt_p)
+      end
+    end
+    local cached
+    repeat
+      tex_fp, tex_key = self:fingerprint(inline and 'code' or 'block', source)
+      pyg_tex_p = self.dir_p..tex_fp..'.pyg.tex'
+      cached = use_cache and (
+        self.use_pack and self:pack_lookup(tex_fp)
+        or self:cache_lookup(tex_fp, pyg_tex_p)
+        or self:store_fetch(tex_fp, pyg_tex_p)
       )
-    )
-    local base = self.dir_p..hash
-    pyg_tex_p = base..'.pyg.tex'
+    until cached or not self:fingerprint_check()
+    local base = self.dir_p..tex_fp
     token.set_macro('l_CDR_pyg_tex_tl', pyg_tex_p)
-    local mode,_,__ = lfs.attributes(pyg_tex_p,'mode')
-    if not mode or not use_cache then
+    if not cached then
       use_py = true
       if debug then
         print('PYTHON SOURCE:', inline)
       end
-      if not inline then
-        local tex_p = base..'.tex'
-        local f = assert(io.open(tex_p, 'w'))
-        local ok, err = f:write(source)
-        f:close()
-        if not ok then
-          print('File error('..tex_p..'): '..err)
+      args.source = source
+      if pygopts.lang == 'auto' then
+        local lang_fp = self:lang_fingerprint(source)
+        local lang = self:lang_lookup(lang_fp)
+        if lang then
+          pygopts.lang = lang
+        elseif not self.use_manifest then
+          cmd = cmd..(' --guess=%s'):format(lang_fp)
         end
-        if debug then
-          print('OUTPUT: '..tex_p)
+      end
+      if self.use_manifest then
+        token.set_macro('l_CDR_pyg_tex_tl', inline
+          and self:manifest_placeholder('pending-code.pyg.tex', '??')
+          or  self:manifest_placeholder('pending-block.pyg.tex', [[
+\CDR@Setup{last=1,}
+\CDR@Line{1}{??}
+]])
+        )
+      end
+      cmd = cmd..(' --base=%q'):format(base)..self:store_arguments()
+      if not self.use_manifest then
+        cmd = cmd..' --report-types'
+      end
+      if not inline and not self.use_manifest
+        and #source > self.stream_size * 1048576 then
+        stream_p = ('%sinput-%s.tex'):format(self.dir_p, uid)
+        if write_atomic(stream_p, source) then
+          args.source = ''
+          cmd = cmd..(' --stream=%q'):format(stream_p)
+        else
+          stream_p = nil
         end
       end
-      cmd = cmd..(' --base=%q'):format(base)
+      if ckpt_p and not stream_p then
+        cmd = cmd..(' --block=%q'):format(ckpt_p)
+      end
+      if self.use_pack and not self.use_manifest and not stream_p then
+        cmd = cmd..(' --pack=%q'):format(self.pack_p)
+      end
     end
   end
-  if use_py then
-    local json_p = self.json_p
-    local f = assert(io.open(json_p, 'w'))
-    local ok, err = f:write(json.tostring(args, true))
-    f:close()
-    if not ok then
-      print('File error('..json_p..'): '..err)
+  if use_py and self.use_manifest then
+    self:manifest_append(cmd, args, tex_key)
+  elseif use_py then
+    if src and not stream_p and (inline or self.use_pack) then
+      cmd = cmd..' --print-tex'
+    end
+    if self.use_stats then
+      cmd = cmd..' --stats'
     end
-    cmd = cmd..('  %q'):format(json_p)
     if debug then
       print('CDR>'..cmd)
     end
-    local o = io.popen(cmd):read('a')
+    local start = self.use_stats and os.gettimeofday()
+    local o = self:server_request(cmd, args)
+    if not o then
+      local json_p = self.json_p
+      local f = assert(io.open(json_p, 'w'))
+      local ok, err = f:write(json.tostring(args))
+      f:close()
+      if not ok then
+        print('File error('..json_p..'): '..err)
+      end
+      o = io.popen(
+        self.PYTHON_PATH..' '..self.CDR_PY_PATH..cmd..('  %q'):format(json_p)
+      ):read('a')
+      os.remove(json_p)
+    end
+    if stream_p then
+      os.remove(stream_p)
+    end
+    if start then
+      self:stats_add('.calls', 1)
+      self:stats_add('.wall', os.gettimeofday() - start)
+    end
     self:load_exec_output(o)
     if debug then
       print('PYTHON', o)
     end
+    if sty_fp then
+      self:cache_index_add(sty_fp, pyg_sty_p)
+    end
+    if tex_fp and not (self.use_pack and self:pack_index()[tex_fp]) then
+      self:cache_index_add(tex_fp, pyg_tex_p)
+    end
   elseif debug then
     print('SAVED>'..cmd)
   end
+  if src and not self.use_manifest then
+    self:style_types_use(pygopts.style, tex_fp, pyg_tex_p)
+  end
   self:cache_record(
     sty and pyg_sty_p or nil,
     src and pyg_tex_p or nil
@@ -292,6 +644,7 @@ local function hilight_code_setup(self)
       style   = 'default',
       mathescape   = JSON_boolean_false,
       escapeinside = '',
+      wrap = '',
     },
     texopts = {
       __cls__ = 'TeXOpts',
@@ -354,6 +707,7 @@ local function hilight_block_setup(self, tags_clist_var)
       texcomments  = JSON_boolean_false,
       mathescape   = JSON_boolean_false,
       escapeinside = '',
+      wrap = '',
     },
     texopts = {
       __cls__ = 'TeXOpts',
@@ -367,6 +721,8 @@ local function hilight_block_setup(self, tags_clist_var)
       __cls__ = 'FVOpts',
       firstnumber = 1,
       stepnumber  = 1,
+      firstline   = '',
+      lastline    = '',
     }
   }
   self.hilight_json_written = false
@@ -417,16 +773,15 @@ local function hilight_block_teardown(self)
     else
       code = escape_inside(table.concat(ll,'\n'),args.pygopts.escapeinside)
     end
-    local records = self['.records'] or {}
-    self['.records'] = records
-    t = {
-      already = {},
-      code = code
-    }
-    for tag in self['.tags clist']:gmatch('([^,]+)') do
-      local tt = records[tag] or {}
-      records[tag] = tt
-      tt[#tt+1] = t
+    local tags = self['.tags clist']
+    if tags:find('[^,]') then
+      local fh = self['.records']
+      if not fh then
+        fh = assert(io.open(self.records_p, 'w'))
+        self['.records'] = fh
+        self:cache_record(nil, self.records_p)
+      end
+      fh:write(tags, '\t', #code, '\n', code, '\n')
     end
   end
 end
@@ -453,54 +808,131 @@ local function append_file_info(self, key, value)
   t[#t+1] = value
 end
 local function export_complete(self)
-  local name    = self['.name']
-print('**** CDR NAME', name)
-  local export  = self['.export']
-  local records = self['.records']
-  local raw  = export.raw  == 'true'
-  local once = export.once == 'true'
-  local tags = export.tags
-  local tt = {}
-  local s, t, _
-print('**** CDR', tags, raw, once)
-  if not raw then
-    s = export.preamble
-    for _,t in ipairs(s) do
-      tt[#tt+1] = t
-    end
-  end
-  for tag in string.gmatch(export.tags, '([^,]+)') do
-    local Rs = records[tag]
-    if Rs then
-      for _,R in ipairs(Rs) do
-        if not R.already[name] or not once then
-          tt[#tt+1] = R.code
+  local export = self['.export']
+  local raw = export.raw == 'true'
+  local exports = self['.exports']
+  exports[#exports+1] = {
+    file      = self['.name'],
+    tags      = export.tags,
+    once      = export.once == 'true' and JSON_boolean_true or JSON_boolean_false,
+    preamble  = not raw and #export.preamble  > 0 and export.preamble  or nil,
+    postamble = not raw and #export.postamble > 0 and export.postamble or nil,
+  }
+  self['.name'] = nil
+  self['.export'] = nil
+end
+local function export_all(self)
+  local fh = self['.records']
+  if fh then
+    fh:close()
+    self['.records'] = nil
+  end
+  local exports = self['.exports']
+  if #exports == 0 then
+    if fh then
+      os.remove(self.records_p)
+    end
+    return
+  end
+  self['.exports'] = {}
+  local records_p = fh and self.records_p or ''
+  if self.PYTHON_PATH and not self.use_manifest then
+    fh = assert(io.open(self.json_p, 'w'))
+    fh:write(json.tostring({
+      records = records_p,
+      exports = exports,
+    }))
+    fh:close()
+    local pipe = io.popen(
+      self.PYTHON_PATH..' '..self.CDR_PY_PATH..(' export %q'):format(self.json_p)
+    )
+    if pipe then
+      print(pipe:read('a'))
+      local ok = pipe:close()
+      os.remove(self.json_p)
+      if ok then
+        os.remove(self.records_p)
+        return
+      end
+      print('coder-util.lua: export failed, exported files are built here')
+    end
+  end
+  local records, by_tag = {}, {}
+  fh = records_p ~= '' and io.open(records_p, 'r')
+  if fh then
+    local s = fh:read('a')
+    fh:close()
+    os.remove(records_p)
+    local i = 1
+    while true do
+      local tags, n, k = s:match('^([^\t\n]*)\t(%d+)\n()', i)
+      if not tags then
+        break
+      end
+      records[#records+1] = s:sub(k, k + n - 1)
+      i = k + n + 1
+      for tag in tags:gmatch('([^,]+)') do
+        local t = by_tag[tag] or {}
+        by_tag[tag] = t
+        t[#t+1] = #records
+      end
+    end
+  end
+  local written, already_by_file = 0, {}
+  for _, export in ipairs(exports) do
+    local tt = {}
+    for _, l in ipairs(export.preamble or {}) do
+      tt[#tt+1] = l
+    end
+    local once = export.once == JSON_boolean_true
+    local already = already_by_file[export.file] or {}
+    already_by_file[export.file] = already
+    for tag in export.tags:gmatch('([^,]+)') do
+      for _, i in ipairs(by_tag[tag] or {}) do
+        if not once or not already[i] then
+          tt[#tt+1] = records[i]
         end
         if once then
-          R.already[name] = true
+          already[i] = true
         end
       end
     end
-  end
-  if not raw then
-    s = export.postamble
-    for _,t in ipairs(s) do
-      tt[#tt+1] = t
+    for _, l in ipairs(export.postamble or {}) do
+      tt[#tt+1] = l
     end
-  end
-print('**** CDR', name, #tt)
-  if #tt>0 then
-    if #tt[#tt] > 0 then
-      tt[#tt+1] = ''
+    if #tt > 0 then
+      if #tt[#tt] > 0 then
+        tt[#tt+1] = ''
+      end
+      if self:export_write(export.file, table.concat(tt, '\n')) then
+        written = written + 1
+      end
     end
-    local fh = assert(io.open(name,'w'))
-    fh:write(table.concat(tt, '\n'))
+  end
+  print(('coder-util.lua: %d exported files written, %d unchanged'):format(
+    written, #exports - written
+  ))
+end
+local function export_write(self, name, contents)
+  local fh = io.open(name, 'r')
+  if fh then
+    local old = fh:read('a')
     fh:close()
+    if old == contents then
+      return false
+    end
   end
-  self['.name'] = nil
-  self['.export'] = nil
+  return assert(write_atomic(name, contents))
 end
 local function cache_clean_all(self)
+  if self:cache_shared() then
+    return
+  end
+  local fh = self['.pack fh']
+  if fh then
+    fh:close()
+    self['.pack fh'] = nil
+  end
   local to_remove = {}
   for f in lfs.dir(self.dir_p) do
     to_remove[f] = true
@@ -508,6 +940,8 @@ local function cache_clean_all(self)
   for k,_ in pairs(to_remove) do
     os.remove(self.dir_p .. k)
   end
+  self['.index'] = nil
+  self['.pack'] = nil
 end
 local function cache_record(self, pyg_sty_p, pyg_tex_p)
   if pyg_sty_p then
@@ -518,16 +952,520 @@ local function cache_record(self, pyg_sty_p, pyg_tex_p)
   end
 end
 local function cache_clean_unused(self)
-  local to_remove = {}
+  if self:cache_shared() then
+    self.cache_keep = true
+  end
+  if not self.cache_keep then
+    local to_remove = {}
+    for f in lfs.dir(self.dir_p) do
+      f = self.dir_p .. f
+      if not self['.style_set'][f] and not self['.colored_set'][f]
+      and not f:match('%.lock$') then
+        to_remove[f] = true
+      end
+    end
+    to_remove[self.index_p] = nil
+    to_remove[self.lock_p] = nil
+    if self.use_pack then
+      to_remove[self.pack_p] = nil
+      to_remove[self.pack_p..'.tsv'] = nil
+    end
+    for f,_ in pairs(to_remove) do
+      os.remove(f)
+    end
+  end
+  self:cache_index_save()
+  self:pack_save()
+  self:cache_used_save()
+  os.remove(self.lock_p)
+end
+local LOCK_REFRESH, LOCK_AGE = 60, 600
+local function cache_lock(self)
+  local now = os.time()
+  if now - (self['.lock time'] or 0) < LOCK_REFRESH then
+    return
+  end
+  self['.lock time'] = now
+  local fh = io.open(self.lock_p, 'w')
+  if fh then
+    fh:write(now, '\n')
+    fh:close()
+  end
+end
+local function cache_shared(self)
+  local now = os.time()
   for f in lfs.dir(self.dir_p) do
-    f = self.dir_p .. f
-    if not self['.style_set'][f] and not self['.colored_set'][f] then
-      to_remove[f] = true
+    local p = self.dir_p..f
+    if p ~= self.lock_p and f:match('%.pyg%.lock$') then
+      local t = lfs.attributes(p, 'modification')
+      if t and now - t < LOCK_AGE then
+        return true
+      end
+      os.remove(p)
+    end
+  end
+end
+local function fingerprint_versions(self)
+  local o = self:server_request('--salt')
+  if not o then
+    local pipe = io.popen(self.PYTHON_PATH..' '..self.CDR_PY_PATH..' --salt')
+    if pipe then
+      o = pipe:read('a')
+      pipe:close()
+    end
+  end
+  o = o and o:match('^%s*(.-)%s*$')
+  return o ~= '' and o or nil
+end
+local function fingerprint_salt(self)
+  local salt = self['.salt']
+  if salt then
+    return salt
+  end
+  self:cache_index()
+  salt = self['.index salt']
+  if (salt or '') == '' and not self.use_manifest and self.PYTHON_PATH then
+    salt = fingerprint_versions(self)
+    self['.salt checked'] = true
+  end
+  salt = salt or ''
+  self['.salt'] = salt
+  self['.index salt'] = salt
+  return salt
+end
+local function fingerprint_check(self)
+  if self['.salt checked'] or self.use_manifest or not self.PYTHON_PATH then
+    return
+  end
+  self['.salt checked'] = true
+  local versions = fingerprint_versions(self)
+  if versions and versions ~= self:fingerprint_salt() then
+    self['.salt'] = versions
+    self['.index salt'] = versions
+    return true
+  end
+end
+local function canonical(t, keys)
+  if not keys then
+    keys = {}
+    for k,_ in pairs(t) do
+      if k ~= '__cls__' then
+        keys[#keys+1] = k
+      end
+    end
+    table.sort(keys)
+  end
+  local tt = {}
+  for _,k in ipairs(keys) do
+    local v = t[k]
+    if v == JSON_boolean_true then
+      v = 'true'
+    elseif v == JSON_boolean_false then
+      v = 'false'
+    end
+    tt[#tt+1] = k..'='..tostring(v)
+  end
+  return table.concat(tt, ';')
+end
+local function fingerprint(self, kind, source)
+  local args = self['.arguments']
+  local t = {
+    kind,
+  }
+  if kind == 'style' then
+    t[#t+1] = canonical(args.pygopts, {
+      'style', 'commandprefix', 'nobackground'
+    })
+    if source then
+      t[#t+1] = 'types='..source
+    end
+  else
+    t[#t+1] = canonical(args.pygopts)
+    t[#t+1] = canonical(args.fv_opts)
+    t[#t+1] = canonical(args.texopts, { 'is_inline' })
+    t[#t+1] = source
+  end
+  local key = md5.sumhexa(table.concat(t, '\n'))
+  return md5.sumhexa(self:fingerprint_salt()..'\n'..key), key
+end
+local function cache_index(self)
+  local index = self['.index']
+  if index then
+    return index
+  end
+  index = {}
+  local artifacts = {}
+  local langs = {}
+  local types = {}
+  local styles = {}
+  self['.index'] = index
+  self['.index artifacts'] = artifacts
+  self['.index langs'] = langs
+  self['.langs used'] = {}
+  self['.index types'] = types
+  self['.types used'] = {}
+  self['.index styles'] = styles
+  local fh = io.open(self.index_p, 'r')
+  if fh then
+    for line in fh:lines() do
+      local k, v = line:match('^([^\t]+)\t(.*)$')
+      if k == '#salt' then
+        self['.index salt'] = v
+      elseif k and k:match('^#lang:') then
+        langs[k:sub(7)] = v
+      elseif k and k:match('^#types:') then
+        types[k:sub(8)] = v
+      elseif k and k:match('^#style:') then
+        styles[k:sub(8)] = v
+      elseif k then
+        index[k] = v
+        artifacts[v] = k
+      end
+    end
+    fh:close()
+  end
+  return index
+end
+local function cache_index_add(self, fp, p)
+  local index = self:cache_index()
+  if lfs.attributes(p, 'mode') then
+    local artifacts = self['.index artifacts']
+    local old = artifacts[p]
+    if old then
+      index[old] = nil
+    end
+    index[fp] = p
+    artifacts[p] = fp
+    return true
+  end
+end
+local function cache_lookup(self, fp, p)
+  local index = self:cache_index()
+  if index[fp] == p then
+    if lfs.attributes(p, 'mode') then
+      return true
+    end
+    index[fp] = nil
+    self['.index artifacts'][p] = nil
+    return
+  end
+  if not self['.index artifacts'][p] then
+    return self:cache_index_add(fp, p)
+  end
+end
+local function cache_index_save(self)
+  local index = self['.index']
+  if not index then
+    return
+  end
+  local t = { '#salt\t'..(self['.index salt'] or '') }
+  for fp, p in pairs(index) do
+    if self['.style_set'][p] or self['.colored_set'][p]
+    or self.cache_keep and lfs.attributes(p, 'mode') then
+      t[#t+1] = fp..'\t'..p
+    end
+  end
+  local used = self['.langs used']
+  for fp, lang in pairs(self['.index langs']) do
+    if used[fp] or self.cache_keep then
+      t[#t+1] = '#lang:'..fp..'\t'..lang
+    end
+  end
+  used = self['.types used']
+  for fp, types in pairs(self['.index types']) do
+    if used[fp] or self.cache_keep then
+      t[#t+1] = '#types:'..fp..'\t'..types
+    end
+  end
+  used = self['.style types']
+  for style, types in pairs(self['.index styles']) do
+    if not used[style] and self.cache_keep then
+      t[#t+1] = '#style:'..style..'\t'..types
     end
   end
-  for f,_ in pairs(to_remove) do
-    os.remove(f)
+  for style in pairs(used) do
+    t[#t+1] = '#style:'..style..'\t'..self:style_types(style)
+  end
+  write_atomic(self.index_p, table.concat(t, '\n')..'\n')
+end
+local function lang_fingerprint(self, source)
+  return md5.sumhexa(self:fingerprint_salt()..'\nlang\n'..source)
+end
+local function lang_lookup(self, fp)
+  self:cache_index()
+  local lang = self['.index langs'][fp]
+  if lang then
+    self['.langs used'][fp] = true
+  end
+  return lang
+end
+local function lang_add(self, fp, lang)
+  self:cache_index()
+  self['.index langs'][fp] = lang
+  self['.langs used'][fp] = true
+end
+local function types_lookup(self, fp)
+  self:cache_index()
+  local types = self['.index types'][fp]
+  if types then
+    self['.types used'][fp] = true
+  end
+  return types
+end
+local function types_add(self, fp, types)
+  self:cache_index()
+  self['.index types'][fp] = types
+  self['.types used'][fp] = true
+end
+local function types_set(types)
+  local set = {}
+  for name in types:gmatch('[^,]+') do
+    set[name] = true
+  end
+  return set
+end
+local function types_scan(s, commandprefix)
+  local pattern = '\\'..(commandprefix or 'Py'):gsub('%p', '%%%0')..'{([^{}]*)}{'
+  local set = {}
+  for names in s:gmatch(pattern) do
+    for name in names:gmatch('[^+]+') do
+      set[name] = true
+    end
+  end
+  local t = {}
+  for name in pairs(set) do
+    t[#t+1] = name
+  end
+  table.sort(t)
+  return table.concat(t, ',')
+end
+local function style_types(self, style)
+  self:cache_index()
+  local old = self['.index styles'][style]
+  local used = self['.style types'][style]
+  if not old and not used then
+    return
+  end
+  local set = types_set(old or '')
+  for name in pairs(used or {}) do
+    set[name] = true
   end
+  local t = {}
+  for name in pairs(set) do
+    t[#t+1] = name
+  end
+  table.sort(t)
+  return table.concat(t, ',')
+end
+local function style_types_use(self, style, fp, p)
+  local types = self:types_lookup(fp)
+  if not types then
+    local s = self['.pyg_tex']
+    if not s then
+      local fh = io.open(p, 'r')
+      if not fh then
+        return
+      end
+      s = fh:read('a')
+      fh:close()
+      if not s then
+        return
+      end
+    end
+    types = types_scan(s, self['.arguments'].pygopts.commandprefix)
+    self:types_add(fp, types)
+  end
+  local used = self['.style types'][style]
+  if not used then
+    used = {}
+    self['.style types'][style] = used
+  end
+  local loaded = self['.style loaded'][style]
+  if type(loaded) == 'string' then
+    loaded = types_set(loaded)
+    self['.style loaded'][style] = loaded
+  end
+  local missing = false
+  for name in types:gmatch('[^,]+') do
+    used[name] = true
+    if type(loaded) == 'table' and not loaded[name] then
+      missing = true
+    end
+  end
+  if missing then
+    local pyg_tex = self['.pyg_tex']
+    self:hilight_source(true, false)
+    self['.pyg_tex'] = pyg_tex
+    self['.style reload'] = { token.get_macro('l_CDR_pyg_sty_tl'), style }
+  end
+end
+local function cache_used_save(self)
+  local used = {}
+  local fh = io.open(self.used_p, 'r')
+  if fh then
+    for line in fh:lines() do
+      local name, t = line:match('^([^\t]+)\t(%d+)$')
+      if name then
+        used[name] = t
+      end
+    end
+    fh:close()
+  end
+  local dir_p = self.dir_p
+  local now = tostring(os.time())
+  for _, set in ipairs({ self['.style_set'], self['.colored_set'] }) do
+    for p, _ in pairs(set) do
+      if p:sub(1, #dir_p) == dir_p then
+        used[p:sub(#dir_p + 1)] = now
+      end
+    end
+  end
+  local pack = self['.pack'] or {}
+  local t = {}
+  for name, time in pairs(used) do
+    if pack[name:match('^(%x+)%.pyg%.tex$') or '']
+    or lfs.attributes(dir_p..name, 'mode') then
+      t[#t+1] = name..'\t'..time
+    end
+  end
+  table.sort(t)
+  write_atomic(self.used_p, table.concat(t, '\n')..'\n')
+end
+local function pack_index(self)
+  local pack = self['.pack']
+  if pack then
+    return pack
+  end
+  pack = {}
+  self['.pack'] = pack
+  local fh = io.open(self.pack_p..'.tsv', 'r')
+  if fh then
+    for line in fh:lines() do
+      local fp, offset, length = line:match('^(%x+)\t(%d+)\t(%d+)$')
+      if fp then
+        pack[fp] = { tonumber(offset), tonumber(length) }
+      end
+    end
+    fh:close()
+  end
+  return pack
+end
+local function pack_add(self, fp, offset, length)
+  self:pack_index()[fp] = { offset, length }
+end
+local function pack_lookup(self, fp)
+  local entry = self:pack_index()[fp]
+  if not entry then
+    return
+  end
+  local fh = self['.pack fh']
+  if not fh then
+    fh = io.open(self.pack_p, 'rb')
+    if not fh then
+      return
+    end
+    self['.pack fh'] = fh
+  end
+  local s = fh:seek('set', entry[1]) and fh:read(entry[2])
+  if not s or #s ~= entry[2] then
+    self['.pack'][fp] = nil
+    return
+  end
+  self['.pyg_tex'] = s
+  return true
+end
+local function pack_save(self)
+  local fh = self['.pack fh']
+  if fh then
+    fh:close()
+    self['.pack fh'] = nil
+  end
+  local pack = self['.pack']
+  if not pack or self.cache_keep or not lock_acquire(self.pack_p) then
+    return
+  end
+  local dir_p = self.dir_p
+  local live = {}
+  local size = 0
+  for fp, entry in pairs(pack) do
+    if self['.colored_set'][dir_p..fp..'.pyg.tex'] then
+      live[#live+1] = fp
+      size = size + entry[2]
+    end
+  end
+  table.sort(live, function (a, b)
+    return pack[a][1] < pack[b][1]
+  end)
+  local t = {}
+  if (lfs.attributes(self.pack_p, 'size') or 0) > 2 * size then
+    fh = io.open(self.pack_p, 'rb')
+    if not fh then
+      lock_release(self.pack_p)
+      return
+    end
+    local chunks = {}
+    local offset = 0
+    for _, fp in ipairs(live) do
+      local entry = pack[fp]
+      fh:seek('set', entry[1])
+      chunks[#chunks+1] = fh:read(entry[2]) or ''
+      t[#t+1] = ('%s\t%d\t%d'):format(fp, offset, #chunks[#chunks])
+      offset = offset + #chunks[#chunks]
+    end
+    fh:close()
+    if not write_atomic(self.pack_p, table.concat(chunks), 'wb') then
+      lock_release(self.pack_p)
+      return
+    end
+  else
+    for _, fp in ipairs(live) do
+      local entry = pack[fp]
+      t[#t+1] = ('%s\t%d\t%d'):format(fp, entry[1], entry[2])
+    end
+  end
+  t[#t+1] = ''
+  write_atomic(self.pack_p..'.tsv', table.concat(t, '\n'))
+  lock_release(self.pack_p)
+end
+local function set_store(self, path_var)
+  local path = assert(token.get_macro(path_var))
+  if path == '' then
+    self.store_p = nil
+    return
+  end
+  if not path:match('/$') then
+    path = path..'/'
+  end
+  self.store_p = path
+end
+local function store_fetch(self, fp, p)
+  local store_p = self.store_p
+  if not store_p or self:fingerprint_salt() == '' then
+    return
+  end
+  local object_p = ('%sobjects/%s/%s.pyg.tex'):format(store_p, fp:sub(1, 2), fp)
+  local fh = io.open(object_p, 'rb')
+  if not fh then
+    return
+  end
+  local contents = fh:read('a')
+  fh:close()
+  if not contents then
+    return
+  end
+  if not write_atomic(p, contents, 'wb') then
+    return
+  end
+  lfs.touch(object_p)
+  return self:cache_index_add(fp, p)
+end
+local function store_arguments(self)
+  if not self.store_p then
+    return ''
+  end
+  return (' --store=%q --store-size=%d'):format(
+    self.store_p, self.store_size
+  )
 end
 local _DESCRIPTION = [[Global coder utilities on the lua side]]
 return {
@@ -541,6 +1479,23 @@ return {
   make_directory     = make_directory,
   load_exec          = load_exec,
   load_exec_output   = load_exec_output,
+  load_exec_next     = load_exec_next,
+  ['.exec queue']    = {},
+  input_pyg_tex      = input_pyg_tex,
+  server_start       = server_start,
+  server_request     = server_request,
+  server_stop        = server_stop,
+  set_preload        = set_preload,
+  server_preload     = server_preload,
+  use_server         = true,
+  preload            = '',
+  manifest_append      = manifest_append,
+  manifest_placeholder = manifest_placeholder,
+  manifest_close       = manifest_close,
+  use_manifest       = false,
+  stats_add          = stats_add,
+  stats_report       = stats_report,
+  use_stats          = false,
   record_line        = record_line,
   hilight_set        = hilight_set,
   hilight_set_var    = hilight_set_var,
@@ -557,16 +1512,62 @@ return {
   cache_clean_all    = cache_clean_all,
   cache_record       = cache_record,
   cache_clean_unused = cache_clean_unused,
+  cache_lock         = cache_lock,
+  cache_shared       = cache_shared,
+  cache_index        = cache_index,
+  cache_index_add    = cache_index_add,
+  cache_index_save   = cache_index_save,
+  lang_fingerprint   = lang_fingerprint,
+  lang_lookup        = lang_lookup,
+  lang_add           = lang_add,
+  types_lookup       = types_lookup,
+  types_add          = types_add,
+  style_types        = style_types,
+  style_types_use    = style_types_use,
+  cache_used_save    = cache_used_save,
+  cache_lookup       = cache_lookup,
+  pack_index         = pack_index,
+  pack_add           = pack_add,
+  pack_lookup        = pack_lookup,
+  pack_save          = pack_save,
+  fingerprint        = fingerprint,
+  fingerprint_salt   = fingerprint_salt,
+  fingerprint_check  = fingerprint_check,
+  set_store          = set_store,
+  store_fetch        = store_fetch,
+  store_arguments    = store_arguments,
+  store_p            = nil,
+  store_size         = 256,
+  stream_size        = 1,
+  ckpt_lines         = 200,
+  cache_keep         = false,
+  use_pack           = false,
   ['.style_set']     = {},
   ['.colored_set']   = {},
   ['.options']       = {},
   ['.export']        = {},
+  ['.exports']       = {},
+  ['.records']       = nil,
+  ['.block counts']  = {},
+  ['.style types']   = {},
+  ['.style loaded']  = {},
+  ['.style reload']  = nil,
+  ['.stats']         = {},
   ['.name']          = nil,
   already            = false,
   dir_p              = dir_p,
   json_p             = json_p,
+  manifest_p         = manifest_p,
+  index_p            = index_p,
+  used_p             = used_p,
+  lock_p             = lock_p,
+  uid                = uid,
+  records_p          = records_p,
+  pack_p             = pack_p,
   export_file        = export_file,
   export_file_info   = export_file_info,
   append_file_info   = append_file_info,
   export_complete    = export_complete,
+  export_all         = export_all,
+  export_write       = export_write,
 }
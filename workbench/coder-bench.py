@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Micro benchmarks for the hot paths of coder-tool.py.
+
+Usage:
+  coder-bench.py [--quick] [--save <baseline.json>] [--compare <baseline.json>]
+
+coder-tool.py is loaded in-process and its Controller is driven directly
+with a generated corpus: inline and block snippets in several languages,
+from small to very large, with or without escapeinside, mathescape and gobble.
+For each case, the latency percentiles, the throughput and the peak memory
+are reported, as well as the startup time of a cold coder-tool process.
+Large blocks are also hilighted with --stream, whose output must be the same
+as without it, whether the lexer is line bounded or not.
+A baseline can be saved then compared with later runs,
+regressions above the threshold are reported and the exit status is 1.
+'''
+import sys
+import os
+import time
+import json
+import argparse
+import contextlib
+import io
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+from pathlib import Path
+from importlib.util import spec_from_file_location, module_from_spec
+
+TOOL_P = Path(__file__).resolve().parent.parent / 'coder-tool.py'
+
+def load_tool(path=TOOL_P):
+  spec = spec_from_file_location('coder_tool', path)
+  module = module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+LINES = {
+  'tex': [
+    r'\section{Section <n>}\label{sec:<n>}',
+    r'Some text with $x_<n>^2 + y$ and \emph{emphasis} % comment <n>',
+    r'\begin{itemize}\item first <n> \item second\end{itemize}',
+    r'\newcommand{\cmd<n>}[1]{\textbf{#1}}',
+  ],
+  'python': [
+    'def function_<n>(a, b=<n>):',
+    '  """Docstring <n> with $x^2$."""',
+    '  value = [i * a for i in range(b)]  # comment <n>',
+    "  return {'key': value, 'n': <n>}",
+  ],
+  'lua': [
+    'local function f<n>(self, a)',
+    '  local t = { n = <n>, s = "string <n>" } -- comment $x^2$',
+    '  for i = 1, #t do t[i] = a * i end',
+    'end',
+  ],
+  'c': [
+    'static int f<n>(int a, const char *s) {',
+    '  /* comment <n> $x^2$ */ int b = a * <n>;',
+    '  printf("%s %d\\n", s, b); // trailing',
+    '}',
+  ],
+  'text': [
+    '2024-01-01 12:00:<n> INFO  request <n> served in 12 ms',
+    '2024-01-01 12:00:<n> WARN  cache miss for key <n>, $x^2$',
+    '2024-01-01 12:00:<n> DEBUG worker <n>\tidle',
+    '',
+  ],
+}
+SIZES = {
+  'inline': 1,
+  'small':  10,
+  'medium': 200,
+  'large':  5000,
+}
+VARIANTS = {
+  'plain':        {},
+  'escapeinside': { 'escapeinside': '||' },
+  'mathescape':   { 'mathescape': True },
+  'gobble':       { 'gobble': 2 },
+}
+
+def make_source(lang, size, gobble=0):
+  templates = LINES[lang]
+  n = SIZES[size]
+  lines = []
+  for i in range(n):
+    line = templates[i % len(templates)].replace('<n>', str(i))
+    if size != 'inline' and i % 7 == 3:
+      line += ' |\\textit{escaped}|'
+    lines.append(' ' * gobble + line)
+  return '\n'.join(lines)
+
+def make_arguments(tool, lang, size, variant, **texopts):
+  options = VARIANTS[variant]
+  gobble = options.get('gobble', 0)
+  source = make_source(lang, size, gobble)
+  if size == 'inline':
+    source = source.replace('\n', ' ')
+  return tool.Arguments({
+    'source': source,
+    'pygopts': tool.PygOpts({
+      'lang': lang,
+      'escapeinside': options.get('escapeinside', ''),
+      'mathescape': options.get('mathescape', False),
+    }),
+    'fv_opts': tool.FVOpts({ 'gobble': gobble }),
+    'texopts': tool.TeXOpts(dict(
+      is_inline = size == 'inline',
+      synctex_tag = 1,
+      synctex_line = 1,
+      **texopts
+    )),
+  })
+
+def percentile(values, p):
+  values = sorted(values)
+  if not values:
+    return 0
+  k = (len(values) - 1) * p / 100
+  i = int(k)
+  j = min(i + 1, len(values) - 1)
+  return values[i] + (values[j] - values[i]) * (k - i)
+
+def measure(run, count, units=1):
+  '''Run `count` times, return the statistics in milliseconds.
+
+  The peak memory is traced during one extra run,
+  tracemalloc would otherwise slow down the timed runs.
+  '''
+  first = None
+  times = []
+  for _ in range(count):
+    t = time.perf_counter()
+    run()
+    t = time.perf_counter() - t
+    if first is None:
+      first = t
+    else:
+      times.append(t)
+  tracemalloc.start()
+  run()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  times = times or [first]
+  total = sum(times)
+  return {
+    'first_ms': 1000 * first,
+    'p50_ms': 1000 * percentile(times, 50),
+    'p90_ms': 1000 * percentile(times, 90),
+    'p99_ms': 1000 * percentile(times, 99),
+    'throughput': len(times) * units / total if total else 0,
+    'peak_kb': peak / 1024,
+  }
+
+# A positional argument is given to the controllers because
+# coder-tool.py prints its help and exits without any argument.
+def bench_pygmentize(tool, count, quick):
+  results = {}
+  for lang in LINES:
+    for size in SIZES:
+      if quick and size == 'large':
+        continue
+      for variant in VARIANTS:
+        arguments = make_arguments(tool, lang, size, variant)
+        n = count if size != 'large' else max(3, count // 20)
+        def run():
+          ctrl = tool.Controller(['coder-tool.py', 'bench'], arguments)
+          ctrl.pygmentize(arguments.source)
+        tool.Controller._lru_caches.clear()
+        results[f'pygmentize/{lang}/{size}/{variant}'] = measure(
+          run, n, SIZES[size]
+        )
+  return results
+
+def bench_create_pygmented(tool, count, tmp_p):
+  results = {}
+  for lang in LINES:
+    for size in ('inline', 'medium'):
+      arguments = make_arguments(tool, lang, size, 'plain')
+      base = str(tmp_p / f'{lang}-{size}')
+      def run():
+        ctrl = tool.Controller(
+          ['coder-tool.py', f'--base={base}', 'bench'], arguments
+        )
+        ctrl.create_pygmented()
+      tool.Controller._lru_caches.clear()
+      results[f'create_pygmented/{lang}/{size}'] = measure(
+        run, count, SIZES[size]
+      )
+  return results
+
+def bench_create_style(tool, count, tmp_p):
+  results = {}
+  store_p = tmp_p / 'cache'
+  os.environ['CODER_CACHE_DIR'] = str(store_p)
+  for style in ('default', 'monokai', 'friendly'):
+    arguments = make_arguments(
+      tool, 'tex', 'inline', 'plain', pyg_sty_p=str(tmp_p / f'{style}.pyg.sty')
+    )
+    arguments.pygopts.style = style
+    def run():
+      ctrl = tool.Controller(
+        ['coder-tool.py', '--create_style', 'bench'], arguments
+      )
+      ctrl.create_style()
+    def run_cold():
+      shutil.rmtree(store_p, ignore_errors=True)
+      tool.Controller._lru_caches.clear()
+      run()
+    results[f'create_style/{style}/cold'] = measure(run_cold, count)
+    results[f'create_style/{style}/warm'] = measure(run, count)
+  return results
+
+def bench_stream(tool, count, tmp_p):
+  '''Hilight the large blocks with --stream, return the statistics
+  and the languages whose streamed output differs from the plain one.
+
+  tex is line bounded and text is plain, both are lexed in windows,
+  the other languages fall back to lexing the whole text at once.
+  '''
+  results = {}
+  mismatches = []
+  for lang in LINES:
+    arguments = make_arguments(tool, lang, 'large', 'plain')
+    source_p = tmp_p / f'{lang}-stream.tex'
+    source_p.write_text(arguments.source, encoding='utf-8')
+    base = str(tmp_p / f'{lang}-stream')
+    def run():
+      ctrl = tool.Controller([
+        'coder-tool.py', f'--base={base}', f'--stream={source_p}', 'bench'
+      ], arguments)
+      ctrl.create_pygmented()
+    tool.Controller._lru_caches.clear()
+    results[f'stream/{lang}/large'] = measure(
+      run, max(3, count // 20), SIZES['large']
+    )
+    expected = tool.Controller(
+      ['coder-tool.py', 'bench'], arguments
+    ).pygmentize(arguments.source)
+    streamed = Path(base).with_suffix('.pyg.tex').read_text(encoding='utf-8')
+    if streamed != expected:
+      mismatches.append(lang)
+  return results, mismatches
+
+def bench_startup(count):
+  def run():
+    subprocess.run(
+      [sys.executable, str(TOOL_P), '--salt'],
+      check=True,
+      stdout=subprocess.DEVNULL,
+    )
+  return { 'startup/--salt': measure(run, count) }
+
+def compare(results, baseline, threshold):
+  regressions = []
+  for name, stats in results.items():
+    old = baseline.get(name)
+    if not old or not old.get('p50_ms'):
+      continue
+    ratio = stats['p50_ms'] / old['p50_ms']
+    if ratio > 1 + threshold:
+      regressions.append((name, old['p50_ms'], stats['p50_ms'], ratio))
+  return regressions
+
+def report(results):
+  print(f'{"case":<44}{"first":>9}{"p50":>9}{"p90":>9}{"p99":>9}'
+    f'{"units/s":>11}{"peak kB":>10}')
+  for name, s in results.items():
+    print(f'{name:<44}{s["first_ms"]:9.2f}{s["p50_ms"]:9.2f}{s["p90_ms"]:9.2f}'
+      f'{s["p99_ms"]:9.2f}{s["throughput"]:11.0f}{s["peak_kb"]:10.0f}')
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+    prog=os.path.basename(argv[0]),
+    description='Micro benchmarks for coder-tool.py, times in milliseconds.'
+  )
+  parser.add_argument(
+    '--count',
+    type=int,
+    default=50,
+    help='the number of runs per case, defaults to 50'
+  )
+  parser.add_argument(
+    '--quick',
+    action='store_true',
+    help='skip the large snippets and run less often'
+  )
+  parser.add_argument(
+    '--save',
+    metavar='<baseline.json>',
+    help='save the results as a baseline'
+  )
+  parser.add_argument(
+    '--compare',
+    metavar='<baseline.json>',
+    help='compare the median latencies with a baseline'
+  )
+  parser.add_argument(
+    '--threshold',
+    type=float,
+    default=0.10,
+    help='relative slowdown reported as a regression, defaults to 0.10'
+  )
+  ns = parser.parse_args(argv[1:])
+  count = max(2, ns.count // 5 if ns.quick else ns.count)
+  tool = load_tool()
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    tmp_p = Path(tmp)
+    with contextlib.redirect_stdout(io.StringIO()):
+      results.update(bench_pygmentize(tool, count, ns.quick))
+      results.update(bench_create_pygmented(tool, count, tmp_p))
+      results.update(bench_create_style(tool, count, tmp_p))
+      stream_results, mismatches = bench_stream(tool, count, tmp_p)
+      results.update(stream_results)
+  results.update(bench_startup(max(2, count // 5)))
+  report(results)
+  status = 0
+  for lang in mismatches:
+    print(f'MISMATCH stream/{lang}: the streamed output differs')
+    status = 1
+  if ns.compare:
+    with open(ns.compare, 'r', encoding='utf-8') as f:
+      baseline = json.load(f)['results']
+    regressions = compare(results, baseline, ns.threshold)
+    for name, old, new, ratio in regressions:
+      print(f'REGRESSION {name}: {old:.2f} ms -> {new:.2f} ms (x{ratio:.2f})')
+    if regressions:
+      status = 1
+    else:
+      print('No regression.')
+  if ns.save:
+    with open(ns.save, 'w', encoding='utf-8') as f:
+      json.dump({
+        'python': sys.version.split()[0],
+        'salt': tool.Controller.salt(),
+        'results': results,
+      }, f, indent=2)
+  return status
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import fileinput
+import os
+import subprocess
 import sys
 
 if len(sys.argv) < 4:
@@ -7,10 +8,10 @@ if len(sys.argv) < 4:
 
 fin = sys.argv[1]
 wrapper = sys.argv[2]
-print(f'File: {fin}')
-with fileinput.input(fin, inplace=True) as file:
-  for cmd in sys.argv[3:]:
-    pattern_find = fR'{{\PYGZbs{{}}{cmd}}}'
-    pattern_sub = fR'{{\{wrapper}{{\PYGZbs{{}}{cmd}}}}}'
-    for line in file:
-      print(line.replace(pattern_find, pattern_sub), end='')
+tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'coder-tool.py')
+sys.exit(subprocess.call([
+  sys.executable, tool, 'postprocess',
+  '--commandprefix=PYG',
+  f'--wrap={wrapper}:{",".join(sys.argv[3:])}',
+  fin,
+]))